@@ -1,22 +1,42 @@
 # RenderApi.py
 import os
 import io
-import uuid
-import tempfile
+import asyncio
+import base64
+import hashlib
+import hmac
+import inspect
+import secrets
+import string
 import logging
+import queue
+import random
 import re
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import combinations
+from logging.handlers import QueueHandler, QueueListener
 from typing import List, Optional, Iterator
-from urllib.parse import urlparse, unquote
+from urllib.parse import unquote
 
+import anyio
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fastapi import FastAPI, Depends, HTTPException, Body, Path, File, UploadFile, Form, Request, Query, Response
-from fastapi.responses import PlainTextResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from fastapi.responses import PlainTextResponse, JSONResponse, StreamingResponse, RedirectResponse
 from sqlalchemy.exc import OperationalError, IntegrityError
 from sqlalchemy import text
 
-# importar la dependencia de BD y helper init_db
-from db import obtener_bd, init_db
-from models import Usuario
+# importar la dependencia de BD y helper de warmup
+from db import obtener_bd, init_db_en_segundo_plano, ping_db_reciente
+from pdf_render import render_pagina, render_paginas, render_paginas_existentes, contar_paginas, PIL_DISPONIBLE
 from schemas import (
     PeticionInicio,
     RespuestaUsuario,
@@ -28,8 +48,25 @@ from schemas import (
     PestanaCreate,
     PestanaUpdate,
     PestanaOut,
+    USUARIOS_LIST,
+    RECURSOS_LIST,
+    PESTANAS_LIST,
 )
 
+# httpx viene con el SDK de supabase; se usa solo para clasificar errores de red
+try:
+    import httpx
+    _ERRORES_RED = (ConnectionError, TimeoutError, httpx.TransportError)
+except Exception:
+    _ERRORES_RED = (ConnectionError, TimeoutError)
+
+# orjson es opcional: si esta instalado se usa como serializador por defecto
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except Exception:
+    DefaultResponse = JSONResponse
+
 # Intento importar cliente Supabase
 try:
     from supabase import create_client, Client
@@ -46,10 +83,33 @@ BUCKET_NAME = os.environ.get("SUPABASE_BUCKET", "pdf")
 if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
     logger.warning("AVISO: SUPABASE_URL o SUPABASE_SERVICE_KEY no estan definidas. Define las variables de entorno.")
 
+# cliente httpx compartido con HTTP/2 (multiplexa storage y postgrest sobre pocas conexiones)
+SUPABASE_HTTP2 = os.environ.get("SUPABASE_HTTP2", "true").lower() in ("1", "true", "yes")
+_supabase_http = None  # se cierra en shutdown
+
+def _crear_cliente_supabase():
+    global _supabase_http
+    if SUPABASE_HTTP2:
+        try:
+            import h2  # noqa: F401  (httpx necesita h2 para http2=True)
+            from supabase import ClientOptions
+            http_client = httpx.Client(
+                http2=True,
+                timeout=httpx.Timeout(30.0, connect=10.0),
+                limits=httpx.Limits(max_connections=120, max_keepalive_connections=80),
+            )
+            cliente = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY, options=ClientOptions(httpx_client=http_client))
+            _supabase_http = http_client
+            return cliente
+        except (ImportError, NameError, TypeError):
+            # sin h2 o SDK sin httpx_client en ClientOptions: cliente por defecto (HTTP/1.1)
+            logger.info("Supabase HTTP/2 no disponible; se usa el cliente por defecto")
+    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+
 supabase: Optional[Client] = None
 if SUPABASE_URL and SUPABASE_SERVICE_KEY and create_client is not None:
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+        supabase = _crear_cliente_supabase()
         logger.info("Supabase client inicializado")
     except Exception:
         supabase = None
@@ -58,7 +118,41 @@ else:
     if create_client is None:
         logger.warning("SDK de supabase no disponible: 'supabase' package no importado")
 
-app = FastAPI(title="FastAPI - Identificacion (Render)")
+# handle del bucket resuelto una vez (from_ crea un proxy nuevo en cada llamada)
+BUCKET = supabase.storage.from_(BUCKET_NAME) if supabase else None
+# la URL publica es deterministica: prefijo fijo + path dentro del bucket
+PUBLIC_URL_PREFIX = f"{(SUPABASE_URL or '').rstrip('/')}/storage/v1/object/public/{BUCKET_NAME}/"
+
+app = FastAPI(title="FastAPI - Identificacion (Render)", default_response_class=DefaultResponse)
+
+# ------------------------------------------------------------------
+# Logging en cola: la escritura a stderr sale del hilo del request
+# ------------------------------------------------------------------
+_log_listeners: List[QueueListener] = []
+
+class _QueueHandlerSinFormato(QueueHandler):
+    # el prepare() estandar formatea y deja args=None; AccessFormatter de uvicorn necesita los args
+    def prepare(self, record):
+        return record
+
+def _activar_logging_en_cola(nombres=("uvicorn", "uvicorn.access")):
+    # mueve los handlers de cada logger a un QueueListener en segundo plano
+    if _log_listeners:
+        return
+    for nombre in nombres:
+        lg = logging.getLogger(nombre)
+        handlers = [h for h in lg.handlers if not isinstance(h, QueueHandler)]
+        if not handlers:
+            continue
+        cola = queue.SimpleQueue()
+        for h in handlers:
+            lg.removeHandler(h)
+        lg.addHandler(_QueueHandlerSinFormato(cola))
+        listener = QueueListener(cola, *handlers, respect_handler_level=True)
+        listener.start()
+        _log_listeners.append(listener)
+
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", "64"))
 
 # ------------------------------------------------------------------
 # Startup: intentar warmup DB
@@ -66,10 +160,43 @@ app = FastAPI(title="FastAPI - Identificacion (Render)")
 @app.on_event("startup")
 def on_startup():
     try:
-        # intenta verificar la BD en startup para reducir errores iniciales
-        init_db(startup_retries=3, startup_delay=1.0)
+        _activar_logging_en_cola()
+    except Exception:
+        logger.exception("No se pudo activar logging en cola")
+    try:
+        # hilos para handlers def (subidas + BD bloqueantes); por defecto anyio usa 40
+        anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
     except Exception:
-        logger.exception("Error en init_db durante startup")
+        logger.exception("No se pudo ajustar el threadpool")
+    try:
+        # verifica la BD y precalienta el pool sin bloquear el arranque
+        init_db_en_segundo_plano(startup_retries=3, startup_delay=1.0)
+    except Exception:
+        logger.exception("Error al lanzar init_db durante startup")
+
+@app.on_event("shutdown")
+def on_shutdown():
+    if _preview_pool is not None:
+        _preview_pool.shutdown(wait=False, cancel_futures=True)
+    _storage_pool.shutdown(wait=False)
+    # cerrar conexiones keep-alive (descargas publicas y cliente httpx de Supabase)
+    HTTP_SESSION.close()
+    if _supabase_http is not None:
+        try:
+            _supabase_http.close()
+        except Exception:
+            pass
+    # vaciar la cola de logs antes de salir
+    while _log_listeners:
+        try:
+            _log_listeners.pop().stop()
+        except Exception:
+            pass
+
+# con la BD caida cada peticion termina en OperationalError/503: el traceback
+# completo solo se formatea con nivel DEBUG (el mensaje se loguea siempre)
+def _traza() -> bool:
+    return logger.isEnabledFor(logging.DEBUG)
 
 # ------------------------------------------------------------------
 # Handler para HTTPException: loggea y pasa headers como Retry-After
@@ -78,41 +205,185 @@ def on_startup():
 async def custom_http_exception_handler(request: Request, exc: HTTPException):
     # Loguear stack trace para 503 y errores criticos
     if exc.status_code == 503:
-        logger.exception("HTTPException 503: %s", exc.detail)
+        logger.error("HTTPException 503: %s", exc.detail, exc_info=_traza())
     # Asegurarse de propagar headers (ej: Retry-After)
     headers = getattr(exc, "headers", None) or {}
-    return JSONResponse(status_code=exc.status_code, content={"error": exc.detail}, headers=headers)
+    return DefaultResponse(status_code=exc.status_code, content={"error": exc.detail}, headers=headers)
 
 # Handler global para debug (mantener pero mas limpio)
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.exception("Unhandled exception: %s", exc)
     if os.environ.get("DEBUG_SHOW_ERROR", "false").lower() in ("1", "true", "yes"):
-        return JSONResponse(status_code=500, content={"error": str(exc)})
-    return JSONResponse(status_code=500, content={"error": "Internal Server Error"})
+        return DefaultResponse(status_code=500, content={"error": str(exc)})
+    return DefaultResponse(status_code=500, content={"error": "Internal Server Error"})
+
+# ------------------------------------------------------------------
+# SQL precompilado: los text() se construyen una sola vez al importar
+# ------------------------------------------------------------------
+def _precompilar_updates(tabla: str, columnas: tuple, returning: str) -> dict:
+    # una sentencia UPDATE por cada combinacion de columnas: {frozenset(cols): TextClause}
+    stmts = {}
+    for n in range(1, len(columnas) + 1):
+        for combo in combinations(columnas, n):
+            set_sql = ", ".join(f"{c} = :{c}" for c in combo)
+            stmts[frozenset(combo)] = text(f"UPDATE {tabla} SET {set_sql} WHERE id = :id RETURNING {returning}")
+    return stmts
+
+# la clave nunca sale de la BD hacia las respuestas (solo login la lee para verificar)
+_USUARIO_COLS = "id, rol, codigo, creado_en"
+_USUARIO_UPDATABLE = ("rol", "codigo", "clave")
+
+# el listado trae solo las columnas de RespuestaUsuario
+SQL_LIST_USUARIOS = text("SELECT id, rol, codigo FROM usuarios ORDER BY id")
+# codigo duplicado => sin fila devuelta (sin excepcion ni rollback)
+SQL_INSERT_USUARIO = text(f"""
+    INSERT INTO usuarios (rol, codigo, clave)
+    VALUES (:rol, :codigo, :clave)
+    ON CONFLICT (codigo) DO NOTHING
+    RETURNING {_USUARIO_COLS}
+""")
+SQL_UPDATE_USUARIO = _precompilar_updates("usuarios", _USUARIO_UPDATABLE, _USUARIO_COLS)
+SQL_DELETE_USUARIO = text("DELETE FROM usuarios WHERE id = :id")
+# login: solo las columnas necesarias, sin instanciar la entidad ORM
+SQL_LOGIN_USUARIO = text("SELECT id, rol, codigo, clave FROM usuarios WHERE codigo = :codigo AND rol = :rol LIMIT 1")
+
+_RECURSO_COLS = "id, titulo, tipo, ruta, file_path, url_youtube, COALESCE(publico, FALSE) AS publico, subido_por, creado_en"
+_RECURSO_UPDATABLE = ("titulo", "tipo", "ruta", "file_path", "url_youtube", "publico", "subido_por")
+
+SQL_LIST_RECURSOS = text(f"SELECT {_RECURSO_COLS} FROM recursos ORDER BY id")
+SQL_SELECT_RECURSO = text(f"SELECT {_RECURSO_COLS} FROM recursos WHERE id = :id")
+SQL_INSERT_RECURSO = text(f"""
+    INSERT INTO recursos (titulo, tipo, ruta, file_path, url_youtube, publico, subido_por)
+    VALUES (:titulo, :tipo, :ruta, :file_path, :url_youtube, :publico, :subido_por)
+    RETURNING {_RECURSO_COLS}
+""")
+# alta masiva: un solo INSERT ... SELECT unnest(arrays) RETURNING, sin ida y vuelta por fila
+SQL_INSERT_RECURSOS_BULK = text(f"""
+    INSERT INTO recursos (titulo, tipo, ruta, file_path, url_youtube, publico, subido_por)
+    SELECT * FROM unnest(
+        CAST(:titulo AS text[]), CAST(:tipo AS text[]), CAST(:ruta AS text[]),
+        CAST(:file_path AS text[]), CAST(:url_youtube AS text[]),
+        CAST(:publico AS boolean[]), CAST(:subido_por AS integer[])
+    )
+    RETURNING {_RECURSO_COLS}
+""")
+SQL_UPDATE_RECURSO = _precompilar_updates("recursos", _RECURSO_UPDATABLE, _RECURSO_COLS)
+SQL_SELECT_RECURSO_ARCHIVO = text("SELECT ruta, file_path FROM recursos WHERE id = :id")
+SQL_SELECT_RECURSO_DESCARGA = text("SELECT ruta, file_path, titulo FROM recursos WHERE id = :id")
+SQL_DELETE_RECURSO = text("DELETE FROM recursos WHERE id = :id")
+SQL_DELETE_RECURSOS_BULK = text("DELETE FROM recursos WHERE id = ANY(:ids) RETURNING id, file_path")
+SQL_INSERT_RECURSO_PDF = text(f"""
+    INSERT INTO recursos (titulo, tipo, ruta, file_path, publico, subido_por)
+    VALUES (:titulo, 'pdf', :ruta, :file_path, :publico, :subido_por)
+    RETURNING {_RECURSO_COLS}
+""")
+
+# orden nulo sale como '{}' desde SQL: las filas se devuelven tal cual, sin tocar cada una
+_PESTANA_COLS = "id, nombre, COALESCE(orden, '{}') AS orden, creado_en"
+_PESTANA_UPDATABLE = ("nombre", "orden")
+
+SQL_LIST_PESTANAS = text(f"SELECT {_PESTANA_COLS} FROM pestanas ORDER BY id")
+SQL_INSERT_PESTANA = text(f"""
+    INSERT INTO pestanas (nombre, orden)
+    VALUES (:nombre, :orden)
+    RETURNING {_PESTANA_COLS}
+""")
+SQL_UPDATE_PESTANA = _precompilar_updates("pestanas", _PESTANA_UPDATABLE, _PESTANA_COLS)
+SQL_DELETE_PESTANA = text("DELETE FROM pestanas WHERE id = :id RETURNING id")
 
 # ---------- helpers ----------
+# listas grandes: validar filas y serializar a JSON en una sola pasada de pydantic-core,
+# sin el dump_python + encoder de FastAPI (response_model queda solo para la documentacion)
+def respuesta_lista(adapter, rows) -> Response:
+    datos = adapter.validate_python(rows, from_attributes=True)
+    return Response(content=adapter.dump_json(datos), media_type="application/json")
+
+# las claves llegan como SecretStr: se desenvuelven solo al pasarlas a la BD o comparar
+def valor_secreto(secreto) -> Optional[str]:
+    return secreto.get_secret_value() if secreto is not None else None
+
+_MARKER_PUBLICO = "/storage/v1/object/public/"
+_PREFIJO_BUCKET = BUCKET_NAME + "/"
+
 def extract_path_from_supabase_public_url(url: str) -> Optional[str]:
-    try:
-        p = urlparse(url)
-        path = unquote(p.path or "")
-        marker = "/storage/v1/object/public/"
-        idx = path.find(marker)
-        if idx == -1:
+    if not isinstance(url, str):
+        return None
+    # partition en vez de urlparse: solo interesa lo que sigue al marcador
+    _, marcador, after = url.partition(_MARKER_PUBLICO)
+    if not marcador:
+        return None
+    after = after.split("?", 1)[0].split("#", 1)[0]
+    if "%" in after:
+        after = unquote(after)
+    if after.startswith(_PREFIJO_BUCKET):
+        return after[len(_PREFIJO_BUCKET):]
+    return after
+
+
+# ---------- reintentos para Supabase Storage ----------
+STORAGE_RETRIES = int(os.environ.get("STORAGE_RETRIES", "4"))
+STORAGE_INITIAL_DELAY = float(os.environ.get("STORAGE_INITIAL_DELAY", "0.25"))
+STORAGE_MAX_DELAY = float(os.environ.get("STORAGE_MAX_DELAY", "4.0"))
+_STATUS_TRANSITORIOS = {429, 502, 503, 504}
+
+def _status_de_error(exc: Exception) -> Optional[int]:
+    # los SDKs exponen el status de formas distintas
+    resp = getattr(exc, "response", None)
+    for v in (getattr(exc, "status_code", None), getattr(exc, "status", None), getattr(resp, "status_code", None)):
+        if v is not None:
+            try:
+                return int(v)
+            except (TypeError, ValueError):
+                pass
+    if exc.args and isinstance(exc.args[0], dict):
+        v = exc.args[0].get("statusCode") or exc.args[0].get("status")
+        try:
+            return int(v) if v is not None else None
+        except (TypeError, ValueError):
             return None
-        after = path[idx + len(marker):]
-        if after.startswith(BUCKET_NAME + "/"):
-            return after[len(BUCKET_NAME) + 1:]
-        return after
-    except Exception:
+    return None
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
         return None
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def _con_reintentos(fn, *args):
+    """
+    Ejecuta fn(*args) reintentando errores transitorios (red, 429, 502-504)
+    con backoff exponencial y jitter. Respeta Retry-After si viene en la respuesta.
+    """
+    delay = STORAGE_INITIAL_DELAY
+    for intento in range(1, STORAGE_RETRIES + 1):
+        try:
+            return fn(*args)
+        except Exception as e:
+            transitorio = isinstance(e, _ERRORES_RED) or _status_de_error(e) in _STATUS_TRANSITORIOS
+            if not transitorio or intento >= STORAGE_RETRIES:
+                raise
+            espera = _retry_after(e)
+            if espera is None:
+                espera = delay + random.uniform(0, delay)
+            espera = min(espera, STORAGE_MAX_DELAY)
+            logger.warning("Storage intento %d/%d fallo (%r); reintentando en %.2fs", intento, STORAGE_RETRIES, e, espera)
+            time.sleep(espera)
+            delay = min(delay * 2, STORAGE_MAX_DELAY)
 
 
 def delete_file_from_supabase(file_path_in_bucket: str) -> dict:
+    return delete_files_from_supabase([file_path_in_bucket])
+
+# remove() del SDK acepta una lista: un solo request HTTP para varios objetos
+def delete_files_from_supabase(paths_in_bucket: List[str]) -> dict:
     if not supabase:
         raise HTTPException(status_code=500, detail="Supabase no esta configurado en el servidor.")
     try:
-        res = supabase.storage.from_(BUCKET_NAME).remove([file_path_in_bucket])
+        res = _con_reintentos(BUCKET.remove, list(paths_in_bucket))
         # algunos SDKs devuelven (data, error) o dict
         if isinstance(res, dict) and res.get("error"):
             raise HTTPException(status_code=500, detail=f"Error al eliminar archivo en Supabase: {res['error']}")
@@ -123,43 +394,83 @@ def delete_file_from_supabase(file_path_in_bucket: str) -> dict:
         logger.exception("Error eliminando archivo en Supabase: %s", e)
         raise HTTPException(status_code=500, detail=f"Error interno al eliminar archivo en Supabase: {str(e)}")
 
+# hilos para llamadas a Storage que pueden ir en paralelo con la BD
+STORAGE_IO_WORKERS = int(os.environ.get("STORAGE_IO_WORKERS", "8"))
+_storage_pool = ThreadPoolExecutor(max_workers=STORAGE_IO_WORKERS, thread_name_prefix="storage")
+
+
+# misma forma que get_public_url del SDK, sin pasar por el SDK
+def obtener_url_publica(path_in_bucket: str) -> str:
+    return PUBLIC_URL_PREFIX + path_in_bucket.lstrip("/")
+
+
+# storage3 solo acepta bytes/BufferedReader/FileIO; cualquier otro objeto lo trata como
+# ruta y hace open(): nunca se le pasa el SpooledTemporaryFile ni un BytesIO
+def _subir_bytes(dest_path_in_bucket: str, file_bytes: bytes, file_options: Optional[dict] = None):
+    return BUCKET.upload(dest_path_in_bucket, file_bytes, file_options)
+
+def _opciones_subida(content_type: Optional[str]) -> Optional[dict]:
+    # sin content-type el SDK sube como text/plain y el navegador no muestra el PDF en linea
+    return {"content-type": content_type} if content_type else None
+
+def upload_bytes_to_supabase(file_bytes: bytes, dest_path_in_bucket: str, content_type: Optional[str] = None) -> str:
+    return _subir_a_supabase(_subir_bytes, file_bytes, dest_path_in_bucket, _opciones_subida(content_type))
+
+def _subir_descriptor(dest_path_in_bucket: str, fileobj, file_options: Optional[dict] = None):
+    # cada intento vuelve al inicio; FileIO comparte el offset del descriptor y
+    # storage3 lo acepta como stream (httpx lo lee por bloques)
+    fileobj.seek(0)
+    return BUCKET.upload(dest_path_in_bucket, io.FileIO(fileobj.fileno(), closefd=False), file_options)
+
+def upload_file_to_supabase(fileobj, dest_path_in_bucket: str, content_type: Optional[str] = None) -> str:
+    """
+    Sube un archivo abierto (p.ej. el SpooledTemporaryFile de un UploadFile).
+    Si ya esta en disco se envia desde su descriptor; si sigue en memoria
+    se lee a bytes (fileno() lo volcaria a disco solo para releerlo).
+    """
+    fileobj.seek(0)
+    if getattr(fileobj, "_rolled", True):
+        try:
+            fileobj.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+        else:
+            return _subir_a_supabase(_subir_descriptor, fileobj, dest_path_in_bucket, _opciones_subida(content_type))
+    return upload_bytes_to_supabase(fileobj.read(), dest_path_in_bucket, content_type)
+
+def _es_duplicado(exc: Exception) -> bool:
+    # Storage responde 409 (o 400 con error "Duplicate") si el objeto ya existe
+    if _status_de_error(exc) == 409:
+        return True
+    return bool(exc.args and isinstance(exc.args[0], dict) and exc.args[0].get("error") == "Duplicate")
+
+def _tolerar_duplicado_en_reintento(fn):
+    # un intento que fallo por red/5xx pudo completarse en el servidor: en el
+    # reintento, "ya existe" en la misma clave significa que la subida llego
+    intentos = 0
+    def _subir(*args):
+        nonlocal intentos
+        intentos += 1
+        try:
+            return fn(*args)
+        except Exception as e:
+            if intentos > 1 and _es_duplicado(e):
+                logger.info("Subida ya completada en un intento previo: %s", args[0])
+                return None
+            raise
+    return _subir
 
-def upload_bytes_to_supabase(file_bytes: bytes, dest_path_in_bucket: str) -> str:
+def _subir_a_supabase(fn, origen, dest_path_in_bucket: str, file_options: Optional[dict] = None) -> str:
     if not supabase:
         raise HTTPException(status_code=500, detail="Supabase no esta configurado en el servidor.")
     try:
-        try:
-            res = supabase.storage.from_(BUCKET_NAME).upload(dest_path_in_bucket, file_bytes)
-        except TypeError:
-            # algunos SDKs esperan file-like objects
-            try:
-                file_obj = io.BytesIO(file_bytes)
-                res = supabase.storage.from_(BUCKET_NAME).upload(dest_path_in_bucket, file_obj)
-            except Exception:
-                # fallback a archivo temporal
-                with tempfile.NamedTemporaryFile(delete=False) as tmp:
-                    tmp.write(file_bytes)
-                    tmp_path = tmp.name
-                try:
-                    res = supabase.storage.from_(BUCKET_NAME).upload(dest_path_in_bucket, tmp_path)
-                finally:
-                    try:
-                        os.remove(tmp_path)
-                    except Exception:
-                        pass
+        res = _con_reintentos(_tolerar_duplicado_en_reintento(fn), dest_path_in_bucket, origen, file_options)
 
         if isinstance(res, dict) and res.get("error"):
             raise HTTPException(status_code=500, detail=f"Error al subir a Supabase: {res['error']}")
 
-        public = supabase.storage.from_(BUCKET_NAME).get_public_url(dest_path_in_bucket)
-        # normalizar distintos retornos
-        if isinstance(public, dict):
-            for k in ("publicUrl", "publicURL", "public_url", "url"):
-                if k in public:
-                    return public[k]
-            return str(public)
-        else:
-            return str(public)
+        # prefijo fijo + path: siempre un str no vacio, los endpoints no vuelven a validarlo
+        return obtener_url_publica(dest_path_in_bucket)
 
     except HTTPException:
         raise
@@ -167,19 +478,82 @@ def upload_bytes_to_supabase(file_bytes: bytes, dest_path_in_bucket: str) -> str
         logger.exception("Error subiendo archivo a Supabase: %s", e)
         raise HTTPException(status_code=500, detail=f"Error interno al subir archivo: {str(e)}")
 
+# ---------- sesion HTTP compartida (keep-alive + pool) para descargas por ruta publica ----------
+HTTP_SESSION = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=frozenset(["GET", "HEAD"])),
+)
+HTTP_SESSION.mount("https://", _http_adapter)
+HTTP_SESSION.mount("http://", _http_adapter)
+HTTP_SESSION.headers.update({"Connection": "keep-alive"})
+
+# ---------- uploads ----------
+# uploads hasta este tamano quedan en memoria (Starlette por defecto vuelca a disco desde 1 MB);
+# con el valor por defecto, mayor que MAX_UPLOAD_BYTES, toda subida aceptada llega en memoria
+UPLOAD_SPOOL_MAX_BYTES = int(os.environ.get("UPLOAD_SPOOL_MAX_BYTES", str(64 << 20)))
+
+try:
+    from starlette.formparsers import MultiPartParser
+    if hasattr(MultiPartParser, "spool_max_size"):
+        MultiPartParser.spool_max_size = UPLOAD_SPOOL_MAX_BYTES
+except Exception:
+    logger.warning("No se pudo ajustar spool_max_size de Starlette")
+
+# limite de subida (50 MB = limite por archivo del plan gratuito de Supabase Storage)
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(50 << 20)))
+_RUTAS_SUBIDA = frozenset(("/recursos/upload", "/recursos/upload_and_create"))
+
+class LimiteSubidaMiddleware:
+    """
+    Rechaza con 413 las subidas cuyo Content-Length supera MAX_UPLOAD_BYTES antes
+    de que Starlette lea y parsee el multipart. ASGI puro: no envuelve el resto de rutas.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in _RUTAS_SUBIDA:
+            for k, v in scope["headers"]:
+                if k == b"content-length":
+                    if v.isdigit() and int(v) > MAX_UPLOAD_BYTES:
+                        resp = DefaultResponse(status_code=413, content={"error": "Archivo demasiado grande"})
+                        await resp(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+app.add_middleware(LimiteSubidaMiddleware)
+
+# sin Content-Length (chunked) el tamano solo se conoce despues del parseo
+def validar_tamano_subida(file: UploadFile) -> None:
+    if (getattr(file, "size", None) or 0) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+
 # -----------------------
 # RUTAS RAIZ y HEALTH
 # -----------------------
+# respuestas precreadas: los probes de Render no alocan un Response por llamada
+_HEALTH_OK = PlainTextResponse("OK", status_code=200)
+_EMPTY_204 = Response(status_code=204)
+
 @app.get("/", include_in_schema=False)
-@app.head("/", include_in_schema=False)
-def raiz_get():
+async def raiz_get():
     return {"mensaje": "API funcionando correctamente"}
 
+@app.head("/", include_in_schema=False)
+async def raiz_head():
+    return _EMPTY_204
+
 # Health simple (sin DB) - aceptar HEAD para Render
 @app.get("/health", response_class=PlainTextResponse)
-@app.head("/health", include_in_schema=False)
 async def health():
-    return PlainTextResponse("OK", status_code=200)
+    return _HEALTH_OK
+
+@app.head("/health", include_in_schema=False)
+async def health_head():
+    return _EMPTY_204
 
 # Health que comprueba la BD (dependencia puede lanzar HTTPException 503)
 @app.get("/health/db", response_class=PlainTextResponse)
@@ -187,11 +561,17 @@ def health_db(db = Depends(obtener_bd)):
     return PlainTextResponse("OK", status_code=200)
 
 # ---------- test db ----------
+# segundos durante los que un contacto exitoso con la BD evita un nuevo ping
+TEST_DB_CACHE_SECONDS = float(os.environ.get("TEST_DB_CACHE_SECONDS", "10"))
+
 @app.get("/test-db")
-def test_db(db = Depends(obtener_bd)):
+def test_db():
     try:
-        row = db.execute(text("SELECT 1")).fetchone()
-        return {"ok": True, "result": row[0] if row else None}
+        if not ping_db_reciente(TEST_DB_CACHE_SECONDS):
+            raise HTTPException(status_code=503, detail="Base de datos temporalmente inaccesible")
+        return {"ok": True, "result": 1}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("test-db error: %s", e)
         return {"ok": False, "error": str(e)}
@@ -202,19 +582,10 @@ def test_db(db = Depends(obtener_bd)):
 @app.get("/usuarios", response_model=List[RespuestaUsuario])
 def listar_usuarios(db = Depends(obtener_bd)):
     try:
-        q = text("SELECT id, rol, codigo, clave, creado_en FROM usuarios ORDER BY id")
-        rows = db.execute(q).mappings().all()
-        result = []
-        for r in rows:
-            result.append({
-                "id": r["id"],
-                "rol": r["rol"],
-                "codigo": r["codigo"],
-                "clave": r["clave"],
-            })
-        return result
+        rows = db.execute(SQL_LIST_USUARIOS).all()
+        return respuesta_lista(USUARIOS_LIST, rows)
     except OperationalError:
-        logger.exception("listar_usuarios: OperationalError")
+        logger.error("listar_usuarios: OperationalError", exc_info=_traza())
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except Exception:
         logger.exception("listar_usuarios: unexpected")
@@ -223,25 +594,20 @@ def listar_usuarios(db = Depends(obtener_bd)):
 @app.post("/usuarios", response_model=RespuestaUsuario, status_code=201)
 def crear_usuario(payload: UsuarioCreate = Body(...), db = Depends(obtener_bd)):
     try:
-        rol_val = payload.rol.value if hasattr(payload.rol, "value") else payload.rol
-        insert_sql = text("""
-            INSERT INTO usuarios (rol, codigo, clave)
-            VALUES (:rol, :codigo, :clave)
-            RETURNING id, rol, codigo, clave, creado_en
-        """)
-        params = {"rol": rol_val, "codigo": payload.codigo, "clave": payload.clave}
-        row = db.execute(insert_sql, params).mappings().fetchone()
+        # rol es un Literal en el schema: ya llega como str
+        params = {"rol": payload.rol, "codigo": payload.codigo, "clave": valor_secreto(payload.clave)}
+        row = db.execute(SQL_INSERT_USUARIO, params).mappings().fetchone()
         db.commit()
         if not row:
-            raise HTTPException(status_code=500, detail="No se pudo crear el usuario")
-        return {"id": row["id"], "rol": row["rol"], "codigo": row["codigo"], "clave": row["clave"]}
+            raise HTTPException(status_code=400, detail="Usuario ya existe o dato invalido")
+        return row
     except IntegrityError as e:
         db.rollback()
         logger.exception("crear_usuario: IntegrityError")
         raise HTTPException(status_code=400, detail="Usuario ya existe o dato invalido")
     except OperationalError:
         db.rollback()
-        logger.exception("crear_usuario: OperationalError")
+        logger.error("crear_usuario: OperationalError", exc_info=_traza())
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except HTTPException:
         raise
@@ -253,34 +619,29 @@ def crear_usuario(payload: UsuarioCreate = Body(...), db = Depends(obtener_bd)):
 @app.put("/usuarios/{usuario_id}", response_model=RespuestaUsuario)
 def actualizar_usuario(usuario_id: int = Path(...), payload: UsuarioUpdate = Body(...), db = Depends(obtener_bd)):
     try:
-        # obtener datos enviados (compatible pydantic v1 y v2)
-        if hasattr(payload, "model_dump"):
-            data = payload.model_dump(exclude_unset=True)
-        else:
-            data = payload.dict(exclude_unset=True)
+        data = payload.model_dump(exclude_unset=True)
 
-        if not data:
+        updates = {k: v for k, v in data.items() if k in _USUARIO_UPDATABLE}
+        if not updates:
             raise HTTPException(status_code=400, detail="No hay campos para actualizar")
+        if "clave" in updates:
+            updates["clave"] = valor_secreto(updates["clave"])
 
-        set_fragments = []
-        params = {"id": usuario_id}
-        idx = 0
-        for k, v in data.items():
-            idx += 1
-            key = f"v{idx}"
-            set_fragments.append(f"{k} = :{key}")
-            params[key] = v
-
-        set_sql = ", ".join(set_fragments)
-        update_sql = text(f"UPDATE usuarios SET {set_sql} WHERE id = :id RETURNING id, rol, codigo, clave, creado_en")
+        # un solo round trip: UPDATE ... RETURNING precompilado segun las columnas enviadas
+        update_sql = SQL_UPDATE_USUARIO[frozenset(updates)]
+        params = {**updates, "id": usuario_id}
         row = db.execute(update_sql, params).mappings().fetchone()
         db.commit()
         if not row:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
-        return {"id": row["id"], "rol": row["rol"], "codigo": row["codigo"], "clave": row["clave"]}
+        return row
+    except IntegrityError:
+        db.rollback()
+        logger.exception("actualizar_usuario: IntegrityError")
+        raise HTTPException(status_code=400, detail="Codigo ya existe o dato invalido")
     except OperationalError:
         db.rollback()
-        logger.exception("actualizar_usuario: OperationalError")
+        logger.error("actualizar_usuario: OperationalError", exc_info=_traza())
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except HTTPException:
         raise
@@ -292,13 +653,12 @@ def actualizar_usuario(usuario_id: int = Path(...), payload: UsuarioUpdate = Bod
 @app.delete("/usuarios/{usuario_id}", response_model=dict)
 def eliminar_usuario(usuario_id: int = Path(...), db = Depends(obtener_bd)):
     try:
-        delete_sql = text("DELETE FROM usuarios WHERE id = :id")
-        db.execute(delete_sql, {"id": usuario_id})
+        db.execute(SQL_DELETE_USUARIO, {"id": usuario_id})
         db.commit()
         return {"ok": True}
     except OperationalError:
         db.rollback()
-        logger.exception("eliminar_usuario: OperationalError")
+        logger.error("eliminar_usuario: OperationalError", exc_info=_traza())
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except Exception as e:
         db.rollback()
@@ -310,41 +670,93 @@ def eliminar_usuario(usuario_id: int = Path(...), db = Depends(obtener_bd)):
 # -------------------------------------------------
 
 # util: sanitizar nombre (para Content-Disposition)
+_SANITIZE_RE = re.compile(r"[^A-Za-z0-9_.-]")
+# ASCII (caso comun): tabla de traduccion, una pasada en C; la regex queda para no-ASCII
+_PERMITIDOS = frozenset(string.ascii_letters + string.digits + "_.-")
+_SANITIZE_TBL = {c: "_" for c in range(128) if chr(c) not in _PERMITIDOS}
+
 def sanitizar_nombre(nombre: Optional[str]) -> str:
     if not nombre:
         nombre = "documento"
-    nombre_seguro = re.sub(r"[^A-Za-z0-9_.-]", "_", nombre)
-    return nombre_seguro[:120]
+    # reemplazo 1 a 1: recortar antes da el mismo resultado con menos trabajo
+    nombre = nombre[:120]
+    if nombre.isascii():
+        return nombre.translate(_SANITIZE_TBL)
+    return _SANITIZE_RE.sub("_", nombre)
+
+# nombre unico dentro del bucket: 32 hex aleatorios + nombre original sin rutas
+def nombre_en_bucket(nombre_archivo: Optional[str]) -> str:
+    base = (nombre_archivo or "").rsplit("/", 1)[-1].rsplit("\\", 1)[-1]
+    return f"{secrets.token_hex(16)}_{sanitizar_nombre(base)}"
 
 # normalizar distintos retornos del SDK de supabase
+def _de_dict(res: dict) -> Optional[bytes]:
+    data = res.get("data")
+    return bytes(data) if isinstance(data, (bytes, bytearray)) else None
+
+def _de_tupla(res) -> Optional[bytes]:
+    # caso tupla (data, error)
+    if res and isinstance(res[0], (bytes, bytearray)):
+        return bytes(res[0])
+    return None
+
+# despacho por tipo exacto, resuelto con un solo lookup; bytes se devuelve sin copiar
+_NORMALIZADORES = {
+    bytes: lambda res: res,
+    bytearray: bytes,
+    dict: _de_dict,
+    tuple: _de_tupla,
+    list: _de_tupla,
+}
+
 def _normalizar_respuesta_supabase(res) -> Optional[bytes]:
+    fn = _NORMALIZADORES.get(type(res))
+    if fn is not None:
+        return fn(res)
     if res is None:
         return None
-    if isinstance(res, dict):
-        if "data" in res and isinstance(res["data"], (bytes, bytearray)):
-            return bytes(res["data"])
-        return None
     if hasattr(res, "read"):
         try:
             return res.read()
         except Exception:
             return None
+    # subclases (p.ej. de bytes o dict) caen al camino lento
     if isinstance(res, (bytes, bytearray)):
         return bytes(res)
-    # caso tupla (data, error)
-    if isinstance(res, (list, tuple)) and len(res) >= 1 and isinstance(res[0], (bytes, bytearray)):
-        return bytes(res[0])
+    if isinstance(res, dict):
+        return _de_dict(res)
     return None
 
+# tamano de bloque para leer/reenviar bodies HTTP (1 MB: pocas iteraciones en PDFs grandes)
+HTTP_CHUNK_SIZE = int(os.environ.get("HTTP_CHUNK_SIZE", str(1 << 20)))
+
+# tope de la preasignacion: Content-Length viene del servidor remoto y no se confia en el
+HTTP_PREALLOC_MAX = int(os.environ.get("HTTP_PREALLOC_MAX_MB", "64")) << 20
+
+# lee el body por bloques; con Content-Length el buffer se preasigna una sola vez
+def _leer_respuesta_completa(resp: requests.Response) -> bytes:
+    try:
+        total = int(resp.headers.get("Content-Length") or 0)
+    except ValueError:
+        total = 0
+    buf = bytearray(min(max(total, 0), HTTP_PREALLOC_MAX))
+    off = 0
+    for chunk in resp.iter_content(chunk_size=HTTP_CHUNK_SIZE):
+        n = len(chunk)
+        # asignacion in-place; solo crece si el servidor envia mas de lo anunciado
+        buf[off:off + n] = chunk
+        off += n
+    if off < len(buf):
+        del buf[off:]
+    # bytes inmutables: el resultado se comparte entre peticiones via las caches
+    return bytes(buf)
+
 # intento de obtener bytes del PDF: storage primero, luego ruta publica HTTP
 def obtener_bytes_pdf_desde_recurso(ruta_publica: Optional[str], path_archivo: Optional[str]) -> bytes:
     # 1) intentar desde supabase storage si existe path_archivo
     if path_archivo and supabase:
         try:
-            try:
-                res = supabase.storage.from_(BUCKET_NAME).download(path_archivo)
-            except TypeError:
-                res = supabase.storage.from_(BUCKET_NAME).download(path_archivo)
+            res = BUCKET.download(path_archivo)
             datos = _normalizar_respuesta_supabase(res)
             if datos:
                 return datos
@@ -358,37 +770,411 @@ def obtener_bytes_pdf_desde_recurso(ruta_publica: Optional[str], path_archivo: O
     # 2) intentar descargar por HTTP desde ruta_publica
     if ruta_publica:
         try:
-            r = requests.get(ruta_publica, timeout=15)
-            r.raise_for_status()
-            return r.content
+            # stream=True: solo se leen cabeceras hasta validar el status, asi que una
+            # ruta invalida no descarga el cuerpo; el with devuelve la conexion al pool
+            with HTTP_SESSION.get(ruta_publica, timeout=15, stream=True) as r:
+                r.raise_for_status()
+                return _leer_respuesta_completa(r)
         except Exception as e:
             logger.exception("Error descargando desde ruta publica: %s", e)
 
     # no se pudo obtener
     raise HTTPException(status_code=404, detail="PDF no encontrado en storage ni en ruta publica")
 
+# cache LRU de PDFs descargados, acotada por bytes: paginas sucesivas del mismo documento
+# no vuelven a descargarlo; una sola descarga por clave aunque lleguen peticiones a la vez
+PDF_CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_MB", "128")) << 20  # 0 = sin cache
+PDF_CACHE_TTL = float(os.environ.get("PDF_CACHE_TTL", "300"))
+_pdf_cache: "OrderedDict[str, tuple]" = OrderedDict()  # clave -> (expira, bytes)
+_pdf_cache_bytes = 0
+_pdf_cache_lock = threading.Lock()
+_pdf_descargas = {}  # clave -> Lock de la descarga en curso
+
+def _pdf_cache_leer(clave: str) -> Optional[bytes]:
+    global _pdf_cache_bytes
+    with _pdf_cache_lock:
+        entrada = _pdf_cache.get(clave)
+        if entrada is None:
+            return None
+        if entrada[0] < time.monotonic():
+            del _pdf_cache[clave]
+            _pdf_cache_bytes -= len(entrada[1])
+            return None
+        _pdf_cache.move_to_end(clave)
+        return entrada[1]
+
+def _pdf_cache_guardar(clave: str, datos: bytes):
+    global _pdf_cache_bytes
+    if len(datos) > PDF_CACHE_MAX_BYTES:
+        return
+    with _pdf_cache_lock:
+        previa = _pdf_cache.pop(clave, None)
+        if previa is not None:
+            _pdf_cache_bytes -= len(previa[1])
+        _pdf_cache[clave] = (time.monotonic() + PDF_CACHE_TTL, datos)
+        _pdf_cache_bytes += len(datos)
+        while _pdf_cache_bytes > PDF_CACHE_MAX_BYTES:
+            _, (_, viejo) = _pdf_cache.popitem(last=False)
+            _pdf_cache_bytes -= len(viejo)
+
+def obtener_bytes_pdf_cacheado(ruta_publica: Optional[str], path_archivo: Optional[str]) -> bytes:
+    clave = path_archivo or ruta_publica
+    if not clave or PDF_CACHE_MAX_BYTES <= 0:
+        return obtener_bytes_pdf_desde_recurso(ruta_publica, path_archivo)
+    datos = _pdf_cache_leer(clave)
+    if datos is not None:
+        return datos
+    with _pdf_cache_lock:
+        lock = _pdf_descargas.setdefault(clave, threading.Lock())
+    try:
+        with lock:
+            # otra peticion pudo completar la descarga mientras se esperaba el lock
+            datos = _pdf_cache_leer(clave)
+            if datos is None:
+                datos = obtener_bytes_pdf_desde_recurso(ruta_publica, path_archivo)
+                _pdf_cache_guardar(clave, datos)
+            return datos
+    finally:
+        with _pdf_cache_lock:
+            if _pdf_descargas.get(clave) is lock:
+                del _pdf_descargas[clave]
+
 # genera destino para preview dentro del bucket (sin '/')
-def generar_destino_preview(path_archivo: str, pagina: int) -> str:
+def generar_destino_preview(path_archivo: str, pagina: int, ext: str = "png", dpi: Optional[int] = None) -> str:
     seguro = path_archivo.replace("/", "_")
-    return f"previews/{seguro}_pagina_{pagina}.png"
+    # el dpi por defecto conserva el nombre historico de las previews ya subidas
+    sufijo = f"_{dpi}dpi" if dpi and dpi != PREVIEW_DPI else ""
+    return f"previews/{seguro}_pagina_{pagina}{sufijo}.{ext}"
+
+# previews ya subidas al bucket: en un hit se redirige a la URL publica sin descargar ni renderizar
+PREVIEW_CACHE_STORAGE = os.environ.get("PREVIEW_CACHE_STORAGE", "1") == "1"
+_PREVIEWS_EN_STORAGE_MAX = 10000
+# las tres tablas se leen y escriben bajo el mismo lock (handlers en el threadpool)
+_previews_lock = threading.Lock()
+# HEAD 200 sobre la URL publica: se puede redirigir
+_previews_en_storage: "OrderedDict[str, None]" = OrderedDict()
+# subida hecha o en curso: no se vuelve a encolar aunque la URL publica no responda (bucket privado)
+_previews_subidas: "OrderedDict[str, None]" = OrderedDict()
+# HEAD sin 200 (o fallido): no se repite hasta que expire, destino -> instante monotonic
+PREVIEW_HEAD_NEG_TTL = float(os.environ.get("PREVIEW_HEAD_NEG_TTL", "300"))
+_previews_sin_url: "OrderedDict[str, float]" = OrderedDict()
+
+def _recordar(tabla: OrderedDict, destino: str, valor=None):
+    # con _previews_lock tomado; al llenarse se descartan las entradas mas antiguas, no la tabla entera
+    tabla[destino] = valor
+    tabla.move_to_end(destino)
+    while len(tabla) > _PREVIEWS_EN_STORAGE_MAX:
+        tabla.popitem(last=False)
+
+def _marcar_subida(destino: str) -> bool:
+    # comprobar y marcar en un solo paso: True si este llamador debe subir la preview
+    with _previews_lock:
+        if destino in _previews_subidas:
+            return False
+        _recordar(_previews_subidas, destino)
+        return True
+
+def _liberar_subida(destino: str):
+    # la subida no llego a hacerse: otra peticion puede intentarlo
+    with _previews_lock:
+        _previews_subidas.pop(destino, None)
+
+def preview_en_storage(destino: str) -> bool:
+    with _previews_lock:
+        if destino in _previews_en_storage:
+            return True
+        expira = _previews_sin_url.get(destino)
+        if expira is not None and expira > time.monotonic():
+            return False
+    # el HEAD va fuera del lock
+    try:
+        r = HTTP_SESSION.head(obtener_url_publica(destino), timeout=3)
+        publica = r.status_code == 200
+    except requests.RequestException:
+        publica = False
+    with _previews_lock:
+        if publica:
+            _previews_sin_url.pop(destino, None)
+            _recordar(_previews_en_storage, destino)
+        else:
+            _recordar(_previews_sin_url, destino, time.monotonic() + PREVIEW_HEAD_NEG_TTL)
+    return publica
+
+def subir_preview(img_bytes: bytes, destino: str, media_type: str) -> Optional[str]:
+    # la preview es deterministica por destino: sobrescribir (upsert) evita el 409 si ya existe
+    url_publica = _subir_a_supabase(_subir_bytes, img_bytes, destino, {"content-type": media_type, "x-upsert": "true"})
+    with _previews_lock:
+        _recordar(_previews_subidas, destino)
+        # la URL publica se vuelve a sondear en la proxima peticion
+        _previews_sin_url.pop(destino, None)
+    return url_publica
+
+def _subir_preview_en_segundo_plano(img_bytes: bytes, destino: str, media_type: str):
+    try:
+        subir_preview(img_bytes, destino, media_type)
+    except Exception:
+        _liberar_subida(destino)
+        logger.exception("Fallo no critico al subir preview")
+
+def programar_subida_preview(img_bytes: bytes, destino: str, media_type: str) -> bool:
+    # una sola subida por destino aunque lleguen varias peticiones antes de que termine
+    if not _marcar_subida(destino):
+        return False
+    try:
+        _storage_pool.submit(_subir_preview_en_segundo_plano, img_bytes, destino, media_type)
+    except RuntimeError:
+        # pool cerrado (shutdown en curso)
+        _liberar_subida(destino)
+        return False
+    return True
+
+# lectura secuencial: tras un fallo de cache se dejan en el bucket las paginas siguientes
+PREVIEW_PREFETCH_PAGINAS = int(os.environ.get("PREVIEW_PREFETCH_PAGINAS", "2"))  # 0 = desactivado
+# pocas tareas a la vez: el precalentado no debe acaparar el pool de storage ni el de render
+_prefetch_sem = threading.BoundedSemaphore(2)
+
+def _precalentar_vecinas(ruta: Optional[str], path_archivo: str, pagina: int, dpi: int, formato: str):
+    try:
+        # se marcan antes de renderizar: el camino normal no sube las mismas a la vez
+        pendientes = {}
+        for p in range(pagina + 1, pagina + 1 + PREVIEW_PREFETCH_PAGINAS):
+            destino = generar_destino_preview(path_archivo, p, formato, dpi)
+            if _marcar_subida(destino):
+                pendientes[p] = destino
+        if not pendientes:
+            return
+        try:
+            # una descarga y una apertura del PDF para todas las vecinas
+            bytes_pdf = obtener_bytes_pdf_cacheado(ruta, path_archivo)
+            media_type = f"image/{formato}"
+            for p, img in _ejecutar_render(render_paginas_existentes, bytes_pdf, list(pendientes), dpi, formato):
+                subir_preview(img, pendientes[p], media_type)
+                del pendientes[p]
+        finally:
+            # las no subidas (error o fuera de rango) quedan libres
+            for destino in pendientes.values():
+                _liberar_subida(destino)
+    except Exception:
+        logger.exception("Fallo no critico al precalentar previews")
+    finally:
+        _prefetch_sem.release()
+
+def programar_precalentado(ruta: Optional[str], path_archivo: str, pagina: int, dpi: int, formato: str):
+    # si ya hay precalentados en curso se omite: es una optimizacion, no un requisito
+    if PREVIEW_PREFETCH_PAGINAS > 0 and _prefetch_sem.acquire(blocking=False):
+        try:
+            _storage_pool.submit(_precalentar_vecinas, ruta, path_archivo, pagina, dpi, formato)
+        except RuntimeError:
+            # pool cerrado (shutdown en curso)
+            _prefetch_sem.release()
+
+# ETag a partir de la identidad del archivo: los objetos del bucket llevan prefijo aleatorio y no se sobreescriben
+def calcular_etag(*partes) -> str:
+    clave = ":".join(str(p) for p in partes)
+    return 'W/"' + hashlib.blake2b(clave.encode(), digest_size=8).hexdigest() + '"'
+
+# If-None-Match con comparacion debil (acepta lista de etags y "*")
+def etag_coincide(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    if inm.strip() == "*":
+        return True
+    propio = etag[2:] if etag.startswith("W/") else etag
+    for candidato in inm.split(","):
+        candidato = candidato.strip()
+        if candidato.startswith("W/"):
+            candidato = candidato[2:]
+        if candidato == propio:
+            return True
+    return False
 
 # iterador para streaming desde requests
-def _iter_requests_content(resp: requests.Response, chunk_size: int = 8192) -> Iterator[bytes]:
+def _iter_requests_content(resp: requests.Response, chunk_size: int = HTTP_CHUNK_SIZE) -> Iterator[bytes]:
     for chunk in resp.iter_content(chunk_size=chunk_size):
         if chunk:
             yield chunk
 
+# pool de procesos para el render: PyMuPDF + codificacion son CPU y evitan el GIL
+PREVIEW_WORKERS = int(os.environ.get("PREVIEW_WORKERS", str(os.cpu_count() or 1)))
+_preview_pool: Optional[ProcessPoolExecutor] = None
+_preview_pool_lock = threading.Lock()
+
+def _obtener_preview_pool() -> Optional[ProcessPoolExecutor]:
+    # se crea en el primer uso (no al importar) para no forkear antes que uvicorn
+    global _preview_pool
+    if PREVIEW_WORKERS <= 0:
+        return None
+    if _preview_pool is None:
+        with _preview_pool_lock:
+            if _preview_pool is None:
+                try:
+                    ctx = multiprocessing.get_context("forkserver")
+                except ValueError:
+                    ctx = None
+                _preview_pool = ProcessPoolExecutor(max_workers=PREVIEW_WORKERS, mp_context=ctx)
+    return _preview_pool
+
+def _ejecutar_render(fn, *args):
+    global _preview_pool
+    try:
+        pool = _obtener_preview_pool()
+        if pool is None:
+            return fn(*args)
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # un worker murio: descartar el pool y renderizar en este proceso
+            logger.exception("Pool de previews roto; se recrea en el proximo uso")
+            with _preview_pool_lock:
+                _preview_pool = None
+            return fn(*args)
+    except IndexError:
+        raise HTTPException(status_code=400, detail="Pagina fuera de rango")
+    except ImportError:
+        logger.exception("PyMuPDF no disponible")
+        raise HTTPException(status_code=500, detail="PyMuPDF no esta instalado en el servidor")
+
+def _render_pagina(bytes_pdf: bytes, pagina: int, dpi: int, formato: str = "png") -> bytes:
+    return _ejecutar_render(render_pagina, bytes_pdf, pagina, dpi, formato)
+
+# cache en memoria de previews ya renderizadas: (ruta, path_archivo, pagina, dpi, formato) -> imagen
+PREVIEW_DPI = 150
+PREVIEW_DPI_MIN = 48
+PREVIEW_DPI_MAX = int(os.environ.get("PREVIEW_DPI_MAX", "200"))
+PREVIEW_CACHE_MAX_BYTES = int(os.environ.get("PREVIEW_CACHE_MAX_MB", "64")) << 20  # 0 = sin cache
+
+class _LRUBytes:
+    # LRU acotada por el total de bytes guardados, no por numero de entradas:
+    # una imagen a dpi alto pesa decenas de veces mas que una miniatura
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._datos: "OrderedDict[tuple, tuple]" = OrderedDict()  # clave -> (valor, tamano)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def leer(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return None
+            self._datos.move_to_end(clave)
+            return entrada[0]
+
+    def guardar(self, clave, valor, tamano: int):
+        if tamano > self.max_bytes:
+            return
+        with self._lock:
+            previa = self._datos.pop(clave, None)
+            if previa is not None:
+                self._bytes -= previa[1]
+            self._datos[clave] = (valor, tamano)
+            self._bytes += tamano
+            while self._bytes > self.max_bytes:
+                _, (_, viejo) = self._datos.popitem(last=False)
+                self._bytes -= viejo
+
+_render_cache = _LRUBytes(PREVIEW_CACHE_MAX_BYTES)
+
+def _render_preview(ruta: Optional[str], path_archivo: Optional[str], pagina: int, dpi: int, formato: str = "png") -> bytes:
+    clave = (ruta, path_archivo, pagina, dpi, formato)
+    img = _render_cache.leer(clave)
+    if img is not None:
+        return img
+    # obtener bytes del PDF (puede lanzar 404)
+    bytes_pdf = obtener_bytes_pdf_cacheado(ruta, path_archivo)
+    img = _render_pagina(bytes_pdf, pagina, dpi, formato)
+    _render_cache.guardar(clave, img, len(img))
+    return img
+
+# variante por lote: una descarga y una sola apertura del PDF para todas las paginas
+PREVIEWS_MAX_PAGINAS = int(os.environ.get("PREVIEWS_MAX_PAGINAS", "20"))
+
+# comparte el presupuesto de bytes con las previews sueltas (la clave lleva una tupla de paginas)
+def _render_previews(ruta: Optional[str], path_archivo: Optional[str], paginas: tuple, dpi: int, formato: str = "png") -> tuple:
+    clave = (ruta, path_archivo, paginas, dpi, formato)
+    imagenes = _render_cache.leer(clave)
+    if imagenes is not None:
+        return imagenes
+    bytes_pdf = obtener_bytes_pdf_cacheado(ruta, path_archivo)
+    imagenes = tuple(_ejecutar_render(render_paginas, bytes_pdf, paginas, dpi, formato))
+    _render_cache.guardar(clave, imagenes, sum(len(img) for img in imagenes))
+    return imagenes
+
+def _parsear_paginas(pages: str) -> tuple:
+    # "0,1,2" -> (0, 1, 2) sin duplicados y respetando el orden
+    try:
+        paginas = tuple(dict.fromkeys(int(p) for p in pages.split(",") if p.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Parametro pages invalido")
+    if not paginas or any(p < 0 for p in paginas):
+        raise HTTPException(status_code=400, detail="Parametro pages invalido")
+    if len(paginas) > PREVIEWS_MAX_PAGINAS:
+        raise HTTPException(status_code=400, detail=f"Maximo {PREVIEWS_MAX_PAGINAS} paginas por peticion")
+    return paginas
+
+# formato de imagen segun Accept: WebP (con Pillow) > JPEG (si se pide explicitamente) > PNG
+def elegir_formato_preview(request: Request) -> str:
+    accept = request.headers.get("accept", "")
+    if PIL_DISPONIBLE and "image/webp" in accept:
+        return "webp"
+    if "image/jpeg" in accept:
+        return "jpeg"
+    return "png"
+
+DOWNLOAD_CACHE_CONTROL = f"public, max-age={int(os.environ.get('DOWNLOAD_MAX_AGE', '86400'))}"
+
+# numero de paginas por archivo: los objetos del bucket no cambian, se calcula una vez
+@lru_cache(maxsize=1024)
+def _contar_paginas(ruta: Optional[str], path_archivo: Optional[str]) -> int:
+    return _ejecutar_render(contar_paginas, obtener_bytes_pdf_cacheado(ruta, path_archivo))
+
+# Endpoint: metadatos -> numero de paginas para armar el paginador, sin renderizar
+@app.get("/recursos/{id_recurso}/meta", response_model=dict)
+def recurso_meta(
+    request: Request,
+    response: Response,
+    id_recurso: int = Path(..., description="ID del recurso"),
+    db = Depends(obtener_bd),
+):
+    try:
+        fila = db.execute(SQL_SELECT_RECURSO_ARCHIVO, {"id": id_recurso}).mappings().fetchone()
+        if not fila:
+            raise HTTPException(status_code=404, detail="Recurso no encontrado")
+
+        ruta = fila.get("ruta")
+        path_archivo = fila.get("file_path")
+        if not path_archivo and ruta:
+            path_archivo = extract_path_from_supabase_public_url(ruta)
+
+        etag = calcular_etag(path_archivo or ruta)
+        headers = {"Cache-Control": DOWNLOAD_CACHE_CONTROL, "ETag": etag}
+        if etag_coincide(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        response.headers.update(headers)
+        return {"page_count": _contar_paginas(ruta, path_archivo), "etag": etag}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error en recurso_meta: %s", e)
+        raise HTTPException(status_code=500, detail="Error interno al leer el PDF")
+
 # Endpoint: preview -> convierte una pagina a PNG
-@app.get("/recursos/{id_recurso}/preview", responses={200: {"content": {"image/png": {}}}})
+# HEAD responde con ETag/Cache-Control sin renderizar; valida la pagina con el conteo
+# memoizado, asi que devuelve el mismo 404/400 que GET
+@app.api_route("/recursos/{id_recurso}/preview", methods=["GET", "HEAD"], responses={200: {"content": {"image/png": {}, "image/webp": {}, "image/jpeg": {}}}})
 def recurso_preview(
+    request: Request,
     id_recurso: int = Path(..., description="ID del recurso"),
     pagina: int = Query(0, ge=0, description="Pagina del PDF (0-index)"),
+    dpi: int = Query(PREVIEW_DPI, ge=PREVIEW_DPI_MIN, le=PREVIEW_DPI_MAX, description="Resolucion del render (96 basta para miniaturas)"),
     subir_cache: bool = Query(False, description="Si true sube preview a Supabase y devuelve X-Preview-Url"),
     db = Depends(obtener_bd),
 ):
     try:
-        consulta = text("SELECT ruta, file_path FROM recursos WHERE id = :id")
-        fila = db.execute(consulta, {"id": id_recurso}).mappings().fetchone()
+        fila = db.execute(SQL_SELECT_RECURSO_ARCHIVO, {"id": id_recurso}).mappings().fetchone()
         if not fila:
             raise HTTPException(status_code=404, detail="Recurso no encontrado")
 
@@ -398,51 +1184,47 @@ def recurso_preview(
         if not path_archivo and ruta:
             path_archivo = extract_path_from_supabase_public_url(ruta)
 
-        # obtener bytes del PDF (puede lanzar 404)
-        bytes_pdf = obtener_bytes_pdf_desde_recurso(ruta, path_archivo)
-
-        # convertir con PyMuPDF
-        try:
-            import fitz  # pymupdf
-        except Exception:
-            logger.exception("PyMuPDF no disponible")
-            raise HTTPException(status_code=500, detail="PyMuPDF no esta instalado en el servidor")
-
-        doc = fitz.open(stream=bytes_pdf, filetype="pdf")
-
-        if pagina < 0 or pagina >= doc.page_count:
-            raise HTTPException(status_code=400, detail="Pagina fuera de rango")
+        # WebP solo si el cliente lo acepta y Pillow esta disponible
+        formato = elegir_formato_preview(request)
+        media_type = f"image/{formato}"
+
+        etag = calcular_etag(path_archivo or ruta, pagina, dpi, formato)
+        headers = {"Cache-Control": "public, max-age=86400, immutable", "ETag": etag, "Vary": "Accept"}
+        # el cliente ya tiene esta preview: ni descarga ni render
+        if etag_coincide(request, etag) and not subir_cache:
+            return Response(status_code=304, headers=headers)
+        if request.method == "HEAD":
+            # 404 si el PDF no esta, 400 si la pagina no existe (como GET)
+            if pagina >= _contar_paginas(ruta, path_archivo):
+                raise HTTPException(status_code=400, detail="Pagina fuera de rango")
+            respuesta = Response(headers=headers, media_type=media_type)
+            # el tamano de la imagen no se conoce sin renderizar: no se anuncia Content-Length: 0
+            del respuesta.headers["content-length"]
+            return respuesta
 
-        pag = doc.load_page(pagina)
-        pix = pag.get_pixmap(dpi=150)
-        img_bytes = pix.tobytes("png")
+        destino = generar_destino_preview(path_archivo, pagina, formato, dpi) if path_archivo and supabase else None
+        # el LRU en memoria va primero: un acierto no paga el HEAD al bucket
+        img_bytes = _render_cache.leer((ruta, path_archivo, pagina, dpi, formato))
+        # preview ya renderizada en el bucket: redirigir, sin descargar el PDF ni renderizar
+        if img_bytes is None and destino and PREVIEW_CACHE_STORAGE and not subir_cache and preview_en_storage(destino):
+            return RedirectResponse(obtener_url_publica(destino), status_code=307, headers=headers)
 
-        headers = {"Cache-Control": "public, max-age=300"}
+        # descarga + render; puede lanzar 404/400
+        if img_bytes is None:
+            img_bytes = _render_preview(ruta, path_archivo, pagina, dpi, formato)
 
-        if subir_cache and path_archivo and supabase:
+        if destino and subir_cache:
             try:
-                destino = generar_destino_preview(path_archivo, pagina)
-                # intentar usar tu helper upload_bytes_to_supabase
-                try:
-                    url_publica = upload_bytes_to_supabase(img_bytes, destino)
-                except Exception:
-                    # fallback directo al SDK
-                    try:
-                        supabase.storage.from_(BUCKET_NAME).upload(destino, io.BytesIO(img_bytes))
-                        pu = supabase.storage.from_(BUCKET_NAME).get_public_url(destino)
-                        if isinstance(pu, dict):
-                            url_publica = pu.get("publicUrl") or pu.get("publicURL") or pu.get("public_url") or str(pu)
-                        else:
-                            url_publica = str(pu)
-                    except Exception as e:
-                        logger.exception("Error subiendo preview via SDK: %s", e)
-                        url_publica = None
+                url_publica = subir_preview(img_bytes, destino, media_type)
                 if url_publica:
                     headers["X-Preview-Url"] = str(url_publica)
             except Exception:
                 logger.exception("Fallo no critico al subir preview")
+        elif destino and PREVIEW_CACHE_STORAGE and programar_subida_preview(img_bytes, destino, media_type):
+            # la subida no retrasa la respuesta; la proxima peticion ya redirige
+            programar_precalentado(ruta, path_archivo, pagina, dpi, formato)
 
-        return Response(content=img_bytes, media_type="image/png", headers=headers)
+        return Response(content=img_bytes, media_type=media_type, headers=headers)
 
     except HTTPException:
         raise
@@ -450,15 +1232,108 @@ def recurso_preview(
         logger.exception("Error en recurso_preview: %s", e)
         raise HTTPException(status_code=500, detail="Error interno al generar preview")
 
+# Endpoint: previews por lote -> varias paginas en base64 con una sola apertura del PDF
+@app.get("/recursos/{id_recurso}/previews", response_model=dict)
+def recurso_previews(
+    request: Request,
+    id_recurso: int = Path(..., description="ID del recurso"),
+    pages: str = Query("0", description="Paginas separadas por coma (0-index), ej: 0,1,2"),
+    dpi: int = Query(PREVIEW_DPI, ge=PREVIEW_DPI_MIN, le=PREVIEW_DPI_MAX, description="Resolucion del render"),
+    db = Depends(obtener_bd),
+):
+    paginas = _parsear_paginas(pages)
+    try:
+        fila = db.execute(SQL_SELECT_RECURSO_ARCHIVO, {"id": id_recurso}).mappings().fetchone()
+        if not fila:
+            raise HTTPException(status_code=404, detail="Recurso no encontrado")
+
+        ruta = fila.get("ruta")
+        path_archivo = fila.get("file_path")
+
+        if not path_archivo and ruta:
+            path_archivo = extract_path_from_supabase_public_url(ruta)
+
+        formato = elegir_formato_preview(request)
+
+        imagenes = _render_previews(ruta, path_archivo, paginas, dpi, formato)
+        return {
+            "media_type": f"image/{formato}",
+            "paginas": [
+                {"pagina": p, "data": base64.b64encode(img).decode("ascii")}
+                for p, img in zip(paginas, imagenes)
+            ],
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error en recurso_previews: %s", e)
+        raise HTTPException(status_code=500, detail="Error interno al generar previews")
+
+# proxy de un PDF por HTTP sin cargarlo en memoria; None si el origen no responde bien
+def respuesta_pdf_streaming(url: str, headers: dict, accept_encoding: str = "") -> Optional[StreamingResponse]:
+    try:
+        r = HTTP_SESSION.get(url, timeout=15, stream=True)
+    except requests.RequestException as e:
+        logger.warning("No se pudo abrir %s para streaming: %s", url, e)
+        return None
+    if not r.ok:
+        r.close()
+        return None
+    headers = dict(headers)
+    codificacion = r.headers.get("Content-Encoding")
+    if codificacion and codificacion.lower() in accept_encoding.lower():
+        # el cliente acepta la misma codificacion: bytes tal cual llegan, Content-Length del origen es valido
+        cuerpo = r.raw.stream(HTTP_CHUNK_SIZE, decode_content=False)
+        headers["Content-Encoding"] = codificacion
+        headers["Vary"] = "Accept-Encoding"
+        if r.headers.get("Content-Length"):
+            headers["Content-Length"] = r.headers["Content-Length"]
+    else:
+        # iter_content descomprime: el Content-Length del origen solo vale sin Content-Encoding
+        cuerpo = _iter_requests_content(r)
+        if not codificacion and r.headers.get("Content-Length"):
+            headers["Content-Length"] = r.headers["Content-Length"]
+    # close al terminar (o si el cliente corta) devuelve la conexion al pool
+    return StreamingResponse(cuerpo, media_type="application/pdf",
+                             headers=headers, background=BackgroundTask(r.close))
+
+# /download redirige a una URL firmada: los bytes los sirve el CDN de Supabase, no este worker
+DOWNLOAD_REDIRECT = os.environ.get("DOWNLOAD_REDIRECT", "1") == "1"
+DOWNLOAD_URL_TTL = int(os.environ.get("DOWNLOAD_URL_TTL", "300"))
+
+# la firma de create_signed_url se inspecciona una vez: los SDK antiguos no aceptan options
+def _firma_acepta_opciones() -> bool:
+    if not supabase:
+        return False
+    try:
+        return len(inspect.signature(BUCKET.create_signed_url).parameters) >= 3
+    except (TypeError, ValueError):
+        return False
+
+_FIRMA_CON_OPCIONES = _firma_acepta_opciones()
+if supabase and not _FIRMA_CON_OPCIONES:
+    logger.warning("create_signed_url sin options: las descargas firmadas no fijan el nombre del archivo")
+
+def url_descarga_firmada(path_archivo: str, nombre: str) -> Optional[str]:
+    if _FIRMA_CON_OPCIONES:
+        # download=nombre: Supabase responde con Content-Disposition attachment
+        res = BUCKET.create_signed_url(path_archivo, DOWNLOAD_URL_TTL, {"download": nombre})
+    else:
+        res = BUCKET.create_signed_url(path_archivo, DOWNLOAD_URL_TTL)
+    if isinstance(res, dict):
+        return res.get("signedURL") or res.get("signedUrl") or res.get("signed_url")
+    return None
+
 # Endpoint: download -> devuelve PDF original (streaming)
 @app.get("/recursos/{id_recurso}/download", responses={200: {"content": {"application/pdf": {}}}})
 def recurso_download(
+    request: Request,
     id_recurso: int = Path(..., description="ID del recurso"),
     db = Depends(obtener_bd),
 ):
     try:
-        consulta = text("SELECT ruta, file_path, titulo FROM recursos WHERE id = :id")
-        fila = db.execute(consulta, {"id": id_recurso}).mappings().fetchone()
+        fila = db.execute(SQL_SELECT_RECURSO_DESCARGA, {"id": id_recurso}).mappings().fetchone()
         if not fila:
             raise HTTPException(status_code=404, detail="Recurso no encontrado")
 
@@ -467,35 +1342,49 @@ def recurso_download(
         titulo = fila.get("titulo") or "documento"
         nombre_seguro = sanitizar_nombre(titulo) + ".pdf"
 
-        # intentar descargar desde supabase storage si path_archivo
+        etag = calcular_etag(path_archivo or ruta)
+        # el mismo id puede pasar a otro archivo (PUT): max-age acotado, sin immutable; el ETag revalida
+        headers = {
+            "Content-Disposition": f'attachment; filename="{nombre_seguro}"',
+            "ETag": etag,
+            "Cache-Control": DOWNLOAD_CACHE_CONTROL,
+        }
+        if (path_archivo or ruta) and etag_coincide(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": DOWNLOAD_CACHE_CONTROL})
+
+        if path_archivo and supabase and DOWNLOAD_REDIRECT:
+            try:
+                url = url_descarga_firmada(path_archivo, nombre_seguro)
+                if url:
+                    # la URL caduca: el redirect no se cachea mas alla de su vigencia
+                    return RedirectResponse(url, status_code=307, headers={"ETag": etag, "Cache-Control": "private, no-store"})
+            except Exception:
+                logger.exception("No se pudo firmar URL de descarga; se sirve por proxy")
+
+        # objeto del bucket: streaming desde su URL publica, memoria O(bloque) y no O(archivo)
+        if path_archivo and supabase:
+            respuesta = respuesta_pdf_streaming(obtener_url_publica(path_archivo), headers, request.headers.get("accept-encoding", ""))
+            if respuesta is not None:
+                return respuesta
+
+        # fallback: descarga completa por el SDK (bucket sin acceso publico)
         if path_archivo and supabase:
             try:
-                res = supabase.storage.from_(BUCKET_NAME).download(path_archivo)
+                res = BUCKET.download(path_archivo)
                 datos = _normalizar_respuesta_supabase(res)
                 if datos is not None:
-                    fileobj = io.BytesIO(datos)
-                    headers = {"Content-Disposition": f'attachment; filename="{nombre_seguro}"'}
-                    return StreamingResponse(fileobj, media_type="application/pdf", headers=headers)
-                # si res es file-like y no lo leimos antes, intentar usarlo directo
-                if hasattr(res, "read") and not isinstance(res, (bytes, bytearray)):
-                    headers = {"Content-Disposition": f'attachment; filename="{nombre_seguro}"'}
-                    try:
-                        return StreamingResponse(res, media_type="application/pdf", headers=headers)
-                    except Exception:
-                        pass
+                    # ya esta en memoria: un solo envio con Content-Length, sin BytesIO ni chunking
+                    return Response(content=datos, media_type="application/pdf", headers=headers)
             except Exception as e:
                 logger.exception("Error descargando desde storage para download: %s", e)
                 # fallback a ruta publica
 
         # fallback: intentar ruta publica por HTTP (si existe)
         if ruta:
-            try:
-                r = requests.get(ruta, timeout=15, stream=True)
-                r.raise_for_status()
-                headers = {"Content-Disposition": f'attachment; filename="{nombre_seguro}"'}
-                return StreamingResponse(_iter_requests_content(r), media_type="application/pdf", headers=headers)
-            except Exception as e:
-                logger.exception("Error descargando ruta publica para download: %s", e)
+            respuesta = respuesta_pdf_streaming(ruta, headers, request.headers.get("accept-encoding", ""))
+            if respuesta is not None:
+                return respuesta
+            logger.error("Error descargando ruta publica para download: %s", ruta)
 
         raise HTTPException(status_code=404, detail="PDF no disponible para descarga")
 
@@ -513,79 +1402,50 @@ def recurso_download(
 @app.get("/recursos", response_model=List[RecursoOut])
 def listar_recursos(db=Depends(obtener_bd)):
     try:
-        q = text("SELECT id, titulo, tipo, ruta, file_path, url_youtube, publico, subido_por, creado_en FROM recursos ORDER BY id")
-        rows = db.execute(q).mappings().all()
-        result = []
-        for r in rows:
-            result.append({
-                "id": r["id"],
-                "titulo": r["titulo"],
-                "tipo": r["tipo"],
-                "ruta": r["ruta"],
-                "file_path": r["file_path"],
-                "url_youtube": r["url_youtube"],
-                "publico": bool(r["publico"]) if r["publico"] is not None else False,
-                "subido_por": r["subido_por"],
-                "creado_en": str(r["creado_en"]) if r["creado_en"] is not None else None
-            })
-        return result
+        rows = db.execute(SQL_LIST_RECURSOS).all()
+        return respuesta_lista(RECURSOS_LIST, rows)
     except OperationalError:
-        logger.exception("listar_recursos: OperationalError")
+        logger.error("listar_recursos: OperationalError", exc_info=_traza())
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except Exception:
         logger.exception("listar_recursos: unexpected")
         raise HTTPException(status_code=500, detail="Error interno al listar recursos")
 
+# host de YouTube anclado al inicio (esquema opcional): rechaza "notyoutube.com" o la cadena en la ruta/query
+_YT_RE = re.compile(r"^(?:https?://)?(?:www\.|m\.)?(?:youtube\.com|youtu\.be)/", re.IGNORECASE)
+
+# valida el payload y arma los parametros del INSERT (compartido por alta simple y masiva)
+def _params_recurso(payload: RecursoCreate) -> dict:
+    if not payload.ruta and not payload.url_youtube:
+        raise HTTPException(status_code=400, detail="Debe proporcionar 'ruta' (archivo) o 'url_youtube'")
+    if payload.url_youtube and not _YT_RE.match(payload.url_youtube):
+        raise HTTPException(status_code=400, detail="url_youtube no parece una URL de YouTube valida")
+
+    file_path_val = payload.file_path
+    if not file_path_val and payload.ruta:
+        file_path_val = extract_path_from_supabase_public_url(payload.ruta)
+
+    return {
+        "titulo": payload.titulo,
+        "tipo": payload.tipo,
+        "ruta": payload.ruta,
+        "file_path": file_path_val,
+        "url_youtube": payload.url_youtube,
+        "publico": payload.publico,
+        "subido_por": payload.subido_por
+    }
+
 @app.post("/recursos", response_model=RecursoOut)
 def crear_recurso(payload: RecursoCreate = Body(...), db=Depends(obtener_bd)):
     try:
-        if not payload.ruta and not payload.url_youtube:
-            raise HTTPException(status_code=400, detail="Debe proporcionar 'ruta' (archivo) o 'url_youtube'")
-        if payload.url_youtube:
-            if "youtube.com" not in payload.url_youtube and "youtu.be" not in payload.url_youtube:
-                raise HTTPException(status_code=400, detail="url_youtube no parece una URL de YouTube valida")
-
-        file_path_val = None
-        try:
-            if hasattr(payload, "file_path") and payload.file_path:
-                file_path_val = payload.file_path
-        except Exception:
-            pass
-
-        if not file_path_val and payload.ruta:
-            file_path_val = extract_path_from_supabase_public_url(payload.ruta)
-
-        insert_sql = text("""
-            INSERT INTO recursos (titulo, tipo, ruta, file_path, url_youtube, publico, subido_por)
-            VALUES (:titulo, :tipo, :ruta, :file_path, :url_youtube, :publico, :subido_por)
-            RETURNING id, titulo, tipo, ruta, file_path, url_youtube, publico, subido_por, creado_en
-        """)
-        params = {
-            "titulo": payload.titulo,
-            "tipo": payload.tipo,
-            "ruta": payload.ruta,
-            "file_path": file_path_val,
-            "url_youtube": payload.url_youtube,
-            "publico": payload.publico,
-            "subido_por": payload.subido_por
-        }
-        row = db.execute(insert_sql, params).mappings().fetchone()
+        params = _params_recurso(payload)
+        row = db.execute(SQL_INSERT_RECURSO, params).mappings().fetchone()
         db.commit()
         if not row:
             raise HTTPException(status_code=500, detail="No se pudo crear el recurso")
-        return {
-            "id": row["id"],
-            "titulo": row["titulo"],
-            "tipo": row["tipo"],
-            "ruta": row["ruta"],
-            "file_path": row.get("file_path"),
-            "url_youtube": row.get("url_youtube"),
-            "publico": bool(row["publico"]) if row["publico"] is not None else False,
-            "subido_por": row.get("subido_por"),
-            "creado_en": str(row["creado_en"]) if row["creado_en"] is not None else None
-        }
+        return row
     except OperationalError:
-        logger.exception("crear_recurso: OperationalError")
+        logger.error("crear_recurso: OperationalError", exc_info=_traza())
         db.rollback()
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except HTTPException:
@@ -595,62 +1455,57 @@ def crear_recurso(payload: RecursoCreate = Body(...), db=Depends(obtener_bd)):
         db.rollback()
         raise HTTPException(status_code=500, detail="Error interno al crear recurso")
 
+BULK_INSERT_MAX = 1000
+
+@app.post("/recursos/bulk", response_model=List[RecursoOut], status_code=201)
+def crear_recursos_bulk(recursos: List[RecursoCreate] = Body(..., embed=True), db=Depends(obtener_bd)):
+    if not recursos:
+        raise HTTPException(status_code=400, detail="No hay recursos para crear")
+    if len(recursos) > BULK_INSERT_MAX:
+        raise HTTPException(status_code=400, detail=f"Maximo {BULK_INSERT_MAX} recursos por peticion")
+    try:
+        filas = [_params_recurso(r) for r in recursos]
+        # columnas como arrays paralelos para unnest
+        params = {k: [f[k] for f in filas] for k in filas[0]}
+        rows = db.execute(SQL_INSERT_RECURSOS_BULK, params).all()
+        db.commit()
+        return rows
+    except OperationalError:
+        logger.error("crear_recursos_bulk: OperationalError", exc_info=_traza())
+        db.rollback()
+        raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("crear_recursos_bulk: unexpected")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="Error interno al crear recursos")
+
 @app.put("/recursos/{recurso_id}", response_model=RecursoOut)
 def actualizar_recurso(recurso_id: int = Path(...), payload: RecursoUpdate = Body(...), db=Depends(obtener_bd)):
     try:
-        select_sql = text("SELECT id, titulo, tipo, ruta, file_path, url_youtube, publico, subido_por, creado_en FROM recursos WHERE id = :id")
-        existing = db.execute(select_sql, {"id": recurso_id}).mappings().fetchone()
-        if not existing:
-            raise HTTPException(status_code=404, detail="Recurso no encontrado")
+        data = payload.model_dump(exclude_unset=True)
 
-        if hasattr(payload, "model_dump"):
-            data = payload.model_dump(exclude_unset=True)
-        else:
-            data = payload.dict(exclude_unset=True)
-
-        allowed = {"titulo", "tipo", "ruta", "file_path", "url_youtube", "publico", "subido_por"}
-        updates = {k: v for k, v in data.items() if k in allowed}
+        updates = {k: v for k, v in data.items() if k in _RECURSO_UPDATABLE}
 
         if not updates:
-            return {
-                "id": existing["id"],
-                "titulo": existing["titulo"],
-                "tipo": existing["tipo"],
-                "ruta": existing["ruta"],
-                "file_path": existing["file_path"],
-                "url_youtube": existing["url_youtube"],
-                "publico": bool(existing["publico"]) if existing["publico"] is not None else False,
-                "subido_por": existing["subido_por"],
-                "creado_en": str(existing["creado_en"]) if existing["creado_en"] is not None else None
-            }
-
-        set_fragments = []
-        params = {"id": recurso_id}
-        idx = 0
-        for k, v in updates.items():
-            idx += 1
-            key = f"v{idx}"
-            set_fragments.append(f"{k} = :{key}")
-            params[key] = v
-        set_sql = ", ".join(set_fragments)
-        update_sql = text(f"UPDATE recursos SET {set_sql} WHERE id = :id RETURNING id, titulo, tipo, ruta, file_path, url_youtube, publico, subido_por, creado_en")
+            # solo este camino necesita leer la fila
+            existing = db.execute(SQL_SELECT_RECURSO, {"id": recurso_id}).mappings().fetchone()
+            if not existing:
+                raise HTTPException(status_code=404, detail="Recurso no encontrado")
+            return existing
+
+        # sentencia precompilada segun las columnas enviadas (sin construir SQL por request)
+        update_sql = SQL_UPDATE_RECURSO[frozenset(updates)]
+        params = {**updates, "id": recurso_id}
+        # sin fila devuelta => el recurso no existe; no hace falta SELECT previo
         row = db.execute(update_sql, params).mappings().fetchone()
         db.commit()
         if not row:
-            raise HTTPException(status_code=500, detail="No se pudo actualizar el recurso")
-        return {
-            "id": row["id"],
-            "titulo": row["titulo"],
-            "tipo": row["tipo"],
-            "ruta": row["ruta"],
-            "file_path": row["file_path"],
-            "url_youtube": row["url_youtube"],
-            "publico": bool(row["publico"]) if row["publico"] is not None else False,
-            "subido_por": row["subido_por"],
-            "creado_en": str(row["creado_en"]) if row["creado_en"] is not None else None
-        }
+            raise HTTPException(status_code=404, detail="Recurso no encontrado")
+        return row
     except OperationalError:
-        logger.exception("actualizar_recurso: OperationalError")
+        logger.error("actualizar_recurso: OperationalError", exc_info=_traza())
         db.rollback()
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except HTTPException:
@@ -663,25 +1518,25 @@ def actualizar_recurso(recurso_id: int = Path(...), payload: RecursoUpdate = Bod
 @app.delete("/recursos/{recurso_id}", response_model=dict)
 def eliminar_recurso(recurso_id: int = Path(...), db=Depends(obtener_bd)):
     try:
-        select_sql = text("SELECT ruta, file_path FROM recursos WHERE id = :id")
-        existing = db.execute(select_sql, {"id": recurso_id}).mappings().fetchone()
+        existing = db.execute(SQL_SELECT_RECURSO_ARCHIVO, {"id": recurso_id}).mappings().fetchone()
         if not existing:
             raise HTTPException(status_code=404, detail="Recurso no encontrado")
 
-        ruta = existing["ruta"]
         file_path = existing["file_path"]
-        if file_path:
+        # el borrado en storage corre en otro hilo mientras la sesion (no thread-safe) borra la fila aqui
+        borrado = _storage_pool.submit(delete_file_from_supabase, file_path) if file_path else None
+
+        db.execute(SQL_DELETE_RECURSO, {"id": recurso_id})
+        db.commit()
+
+        if borrado is not None:
             try:
-                delete_file_from_supabase(file_path)
+                borrado.result()
             except HTTPException:
                 logger.exception("eliminar_recurso: fallo al eliminar archivo en supabase")
-
-        delete_sql = text("DELETE FROM recursos WHERE id = :id")
-        db.execute(delete_sql, {"id": recurso_id})
-        db.commit()
         return {"ok": True}
     except OperationalError:
-        logger.exception("eliminar_recurso: OperationalError")
+        logger.error("eliminar_recurso: OperationalError", exc_info=_traza())
         db.rollback()
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except HTTPException:
@@ -691,19 +1546,78 @@ def eliminar_recurso(recurso_id: int = Path(...), db=Depends(obtener_bd)):
         db.rollback()
         raise HTTPException(status_code=500, detail="Error interno al eliminar recurso")
 
+# borrado masivo: 1 DELETE ... RETURNING + 1 remove() en storage, sin importar cuantos ids
+BULK_DELETE_MAX = 1000  # limite de objetos por remove() en Supabase Storage
+
+@app.post("/recursos/delete_bulk", response_model=dict)
+def eliminar_recursos_bulk(ids: List[int] = Body(..., embed=True), db=Depends(obtener_bd)):
+    if not ids:
+        raise HTTPException(status_code=400, detail="No hay ids para eliminar")
+    if len(ids) > BULK_DELETE_MAX:
+        raise HTTPException(status_code=400, detail=f"Maximo {BULK_DELETE_MAX} ids por peticion")
+    try:
+        rows = db.execute(SQL_DELETE_RECURSOS_BULK, {"ids": list(set(ids))}).all()
+        db.commit()
+
+        paths = [r.file_path for r in rows if r.file_path]
+        if paths:
+            try:
+                delete_files_from_supabase(paths)
+            except HTTPException:
+                logger.exception("eliminar_recursos_bulk: fallo al eliminar archivos en supabase")
+        return {"ok": True, "eliminados": [r.id for r in rows]}
+    except OperationalError:
+        logger.error("eliminar_recursos_bulk: OperationalError", exc_info=_traza())
+        db.rollback()
+        raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("eliminar_recursos_bulk: unexpected")
+        db.rollback()
+        raise HTTPException(status_code=500, detail="Error interno al eliminar recursos")
+
 # ---------- storage endpoints ----------
-@app.post("/recursos/upload", response_model=dict)
+@app.post("/recursos/signed_upload", response_model=dict)
+def crear_subida_firmada(nombre_archivo: str = Body(..., embed=True)):
+    """
+    Devuelve una URL firmada para que el cliente suba el archivo directo a Supabase
+    (PUT a "url"); despues se registra con POST /recursos usando "ruta" y "file_path".
+    """
+    if not supabase:
+        raise HTTPException(status_code=500, detail="Supabase no esta configurado en el servidor.")
+    try:
+        dest_path = nombre_en_bucket(nombre_archivo)
+        res = BUCKET.create_signed_upload_url(dest_path)
+        if isinstance(res, dict) and res.get("error"):
+            raise HTTPException(status_code=500, detail=f"Error al firmar subida en Supabase: {res['error']}")
+        # normalizar distintos retornos del SDK
+        url = None
+        token = None
+        if isinstance(res, dict):
+            url = res.get("signed_url") or res.get("signedUrl") or res.get("signedURL") or res.get("url")
+            token = res.get("token")
+        if not url:
+            raise HTTPException(status_code=500, detail="No se obtuvo URL firmada de Supabase.")
+        return {"url": url, "token": token, "file_path": dest_path, "ruta": obtener_url_publica(dest_path)}
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("crear_subida_firmada: unexpected")
+        raise HTTPException(status_code=500, detail="Error interno al firmar subida")
+
+# obsoleto: preferir /recursos/signed_upload (el archivo no pasa por este servidor)
+@app.post("/recursos/upload", response_model=dict, deprecated=True)
 async def upload_recurso_file(file: UploadFile = File(...)):
     if not supabase:
         raise HTTPException(status_code=500, detail="Supabase no esta configurado en el servidor.")
+    validar_tamano_subida(file)
     try:
-        raw = await file.read()
-        filename = f"{uuid.uuid4().hex}_{file.filename}"
+        filename = nombre_en_bucket(file.filename)
         dest_path = filename
 
-        public_url = upload_bytes_to_supabase(raw, dest_path)
-        if not public_url or not isinstance(public_url, str):
-            raise HTTPException(status_code=500, detail="No se obtuvo URL publica despues de subir el archivo.")
+        # sin file.read() propio (el helper decide bytes o descriptor); en un hilo porque bloquea
+        public_url = await asyncio.to_thread(upload_file_to_supabase, file.file, dest_path, file.content_type)
         return {"ruta": public_url, "file_path": dest_path}
     except HTTPException:
         raise
@@ -724,8 +1638,9 @@ def delete_file_endpoint(file_path: str = Path(..., description="Ruta relativa d
         logger.exception("delete_file_endpoint: unexpected")
         raise HTTPException(status_code=500, detail="Error interno al eliminar archivo")
 
-@app.post("/recursos/upload_and_create", response_model=dict)
-async def upload_and_create_recurso(
+# def (no async): SDK y driver son bloqueantes, FastAPI lo ejecuta en su threadpool
+@app.post("/recursos/upload_and_create", response_model=RecursoOut)
+def upload_and_create_recurso(
     titulo: str = Form(...),
     publico: Optional[bool] = Form(False),
     subido_por: Optional[int] = Form(None),
@@ -736,107 +1651,69 @@ async def upload_and_create_recurso(
         raise HTTPException(status_code=500, detail="Supabase no esta configurado en el servidor.")
     if not titulo or titulo.strip() == "":
         raise HTTPException(status_code=400, detail="El campo 'titulo' es requerido.")
+    validar_tamano_subida(file)
+
+    nombre = nombre_en_bucket(file.filename)
 
-    nombre = None
     try:
-        try:
-            contenido = await file.read()
-        except Exception as e:
-            logger.exception("upload_and_create_recurso: no se pudo leer archivo: %s", e)
-            raise HTTPException(status_code=500, detail=f"No se pudo leer el archivo: {str(e)}")
+        # sin file.read() propio: el helper sube desde el descriptor si el spool ya esta en disco
+        public = upload_file_to_supabase(file.file, nombre, file.content_type or "application/pdf")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("upload_and_create_recurso: error subiendo archivo: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error al subir archivo: {str(e)}")
 
-        nombre = f"{uuid.uuid4().hex}_{file.filename}"
+    try:
+        params = {
+            "titulo": titulo,
+            "ruta": public,
+            "file_path": nombre,
+            "publico": publico,
+            "subido_por": subido_por
+        }
+        row = db.execute(SQL_INSERT_RECURSO_PDF, params).mappings().fetchone()
+        db.commit()
+        if not row:
+            try:
+                delete_file_from_supabase(nombre)
+            except Exception:
+                logger.exception("upload_and_create_recurso: fallo cleanup archivo")
+            raise HTTPException(status_code=500, detail="No se pudo crear el registro en la base de datos.")
+        return row
 
+    except OperationalError:
+        logger.error("upload_and_create_recurso: OperationalError", exc_info=_traza())
         try:
-            public = upload_bytes_to_supabase(contenido, nombre)
-            if not public or not isinstance(public, str):
-                raise HTTPException(status_code=500, detail="No se obtuvo URL publica despues de subir el archivo.")
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.exception("upload_and_create_recurso: error subiendo archivo: %s", e)
-            raise HTTPException(status_code=500, detail=f"Error al subir archivo: {str(e)}")
-
+            if nombre:
+                delete_file_from_supabase(nombre)
+        except Exception:
+            logger.exception("upload_and_create_recurso: fallo cleanup OperationalError")
+        db.rollback()
+        raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("upload_and_create_recurso: unexpected: %s", e)
         try:
-            insert_sql = text("""
-                INSERT INTO recursos (titulo, tipo, ruta, file_path, publico, subido_por)
-                VALUES (:titulo, 'pdf', :ruta, :file_path, :publico, :subido_por)
-                RETURNING id, titulo, tipo, ruta, file_path, publico, subido_por, creado_en
-            """)
-            params = {
-                "titulo": titulo,
-                "ruta": public,
-                "file_path": nombre,
-                "publico": publico,
-                "subido_por": subido_por
-            }
-            row = db.execute(insert_sql, params).mappings().fetchone()
-            db.commit()
-            if not row:
-                try:
-                    delete_file_from_supabase(nombre)
-                except Exception:
-                    logger.exception("upload_and_create_recurso: fallo cleanup archivo")
-                raise HTTPException(status_code=500, detail="No se pudo crear el registro en la base de datos.")
-
-            respuesta = {
-                "id": row["id"],
-                "titulo": row["titulo"],
-                "tipo": row["tipo"],
-                "ruta": row["ruta"],
-                "file_path": row["file_path"],
-                "publico": bool(row["publico"]) if row["publico"] is not None else False,
-                "subido_por": row["subido_por"],
-                "creado_en": str(row["creado_en"]) if row["creado_en"] is not None else None
-            }
-            return respuesta
-
-        except OperationalError:
-            logger.exception("upload_and_create_recurso: OperationalError")
-            try:
-                if nombre:
-                    delete_file_from_supabase(nombre)
-            except Exception:
-                logger.exception("upload_and_create_recurso: fallo cleanup OperationalError")
-            db.rollback()
-            raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.exception("upload_and_create_recurso: unexpected: %s", e)
-            try:
-                if nombre:
-                    delete_file_from_supabase(nombre)
-            except Exception:
-                logger.exception("upload_and_create_recurso: fallo cleanup unexpected")
-            try:
-                db.rollback()
-            except Exception:
-                pass
-            raise HTTPException(status_code=500, detail=f"Error interno al crear el recurso: {str(e)}")
-    finally:
+            if nombre:
+                delete_file_from_supabase(nombre)
+        except Exception:
+            logger.exception("upload_and_create_recurso: fallo cleanup unexpected")
         try:
-            contenido = None
+            db.rollback()
         except Exception:
             pass
+        raise HTTPException(status_code=500, detail=f"Error interno al crear el recurso: {str(e)}")
 
 # ---------- pestanas CRUD ----------
 @app.get("/pestanas", response_model=List[PestanaOut])
 def listar_pestanas(db = Depends(obtener_bd)):
     try:
-        q = text("SELECT id, nombre, orden, creado_en FROM pestanas ORDER BY id")
-        rows = db.execute(q).mappings().all()
-        result = []
-        for r in rows:
-            result.append({
-                "id": r["id"],
-                "nombre": r["nombre"],
-                "orden": list(r["orden"]) if r["orden"] is not None else [],
-                "creado_en": str(r["creado_en"]) if r["creado_en"] is not None else None
-            })
-        return result
+        rows = db.execute(SQL_LIST_PESTANAS).all()
+        return respuesta_lista(PESTANAS_LIST, rows)
     except OperationalError:
-        logger.exception("listar_pestanas: OperationalError")
+        logger.error("listar_pestanas: OperationalError", exc_info=_traza())
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except Exception:
         logger.exception("listar_pestanas: unexpected")
@@ -845,27 +1722,17 @@ def listar_pestanas(db = Depends(obtener_bd)):
 @app.post("/pestanas", response_model=PestanaOut, status_code=201)
 def crear_pestana(payload: PestanaCreate = Body(...), db = Depends(obtener_bd)):
     try:
-        insert_sql = text("""
-            INSERT INTO pestanas (nombre, orden)
-            VALUES (:nombre, :orden)
-            RETURNING id, nombre, orden, creado_en
-        """)
         params = {
             "nombre": payload.nombre,
             "orden": payload.orden or []
         }
-        row = db.execute(insert_sql, params).mappings().fetchone()
+        row = db.execute(SQL_INSERT_PESTANA, params).mappings().fetchone()
         db.commit()
         if not row:
             raise HTTPException(status_code=500, detail="No se pudo crear la pestana")
-        return {
-            "id": row["id"],
-            "nombre": row["nombre"],
-            "orden": list(row["orden"]) if row["orden"] is not None else [],
-            "creado_en": str(row["creado_en"]) if row["creado_en"] is not None else None
-        }
+        return row
     except OperationalError:
-        logger.exception("crear_pestana: OperationalError")
+        logger.error("crear_pestana: OperationalError", exc_info=_traza())
         db.rollback()
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except HTTPException:
@@ -878,55 +1745,28 @@ def crear_pestana(payload: PestanaCreate = Body(...), db = Depends(obtener_bd)):
 @app.put("/pestanas/{pestana_id}", response_model=PestanaOut)
 def actualizar_pestana(pestana_id: int = Path(...), payload: PestanaUpdate = Body(...), db = Depends(obtener_bd)):
     try:
-        select_sql = text("SELECT id, nombre, orden, creado_en FROM pestanas WHERE id = :id")
-        existing = db.execute(select_sql, {"id": pestana_id}).mappings().fetchone()
-        if not existing:
-            raise HTTPException(status_code=404, detail="Pestana no encontrada")
-
-        # obtener datos enviados (compatible pydantic v1 y v2)
-        if hasattr(payload, "model_dump"):
-            data = payload.model_dump(exclude_unset=True)
-        else:
-            data = payload.dict(exclude_unset=True)
+        data = payload.model_dump(exclude_unset=True)
 
         data.pop("id", None)
         data.pop("creado_en", None)
 
-        allowed = {"nombre", "orden"}
-        updates = {k: v for k, v in data.items() if k in allowed}
+        updates = {k: v for k, v in data.items() if k in _PESTANA_UPDATABLE}
 
         if not updates:
-            # nada que actualizar; devolver la fila existente
-            return {
-                "id": existing["id"],
-                "nombre": existing["nombre"],
-                "orden": list(existing["orden"]) if existing["orden"] is not None else [],
-                "creado_en": str(existing["creado_en"]) if existing["creado_en"] is not None else None
-            }
-
-        set_fragments = []
-        params = {"id": pestana_id}
-        idx = 0
-        for k, v in updates.items():
-            idx += 1
-            key = f"v{idx}"
-            set_fragments.append(f"{k} = :{key}")
-            params[key] = v
-
-        set_sql = ", ".join(set_fragments)
-        update_sql = text(f"UPDATE pestanas SET {set_sql} WHERE id = :id RETURNING id, nombre, orden, creado_en")
+            # igual que usuarios: un PUT vacio no toca la BD
+            raise HTTPException(status_code=400, detail="No hay campos para actualizar")
+
+        # UPDATE precompilado segun las columnas enviadas (3 formas posibles)
+        update_sql = SQL_UPDATE_PESTANA[frozenset(updates)]
+        params = {**updates, "id": pestana_id}
+        # UPDATE ... RETURNING sin fila => la pestana no existe (sin SELECT previo)
         row = db.execute(update_sql, params).mappings().fetchone()
         db.commit()
         if not row:
-            raise HTTPException(status_code=500, detail="No se pudo actualizar la pestana")
-        return {
-            "id": row["id"],
-            "nombre": row["nombre"],
-            "orden": list(row["orden"]) if row["orden"] is not None else [],
-            "creado_en": str(row["creado_en"]) if row["creado_en"] is not None else None
-        }
+            raise HTTPException(status_code=404, detail="Pestana no encontrada")
+        return row
     except OperationalError:
-        logger.exception("actualizar_pestana: OperationalError")
+        logger.error("actualizar_pestana: OperationalError", exc_info=_traza())
         db.rollback()
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except HTTPException:
@@ -939,17 +1779,14 @@ def actualizar_pestana(pestana_id: int = Path(...), payload: PestanaUpdate = Bod
 @app.delete("/pestanas/{pestana_id}", response_model=dict)
 def eliminar_pestana(pestana_id: int = Path(...), db = Depends(obtener_bd)):
     try:
-        select_sql = text("SELECT id FROM pestanas WHERE id = :id")
-        existing = db.execute(select_sql, {"id": pestana_id}).mappings().fetchone()
-        if not existing:
-            raise HTTPException(status_code=404, detail="Pestana no encontrada")
-
-        delete_sql = text("DELETE FROM pestanas WHERE id = :id")
-        db.execute(delete_sql, {"id": pestana_id})
+        # un solo round trip: RETURNING indica si la fila existia
+        row = db.execute(SQL_DELETE_PESTANA, {"id": pestana_id}).first()
         db.commit()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Pestana no encontrada")
         return {"ok": True}
     except OperationalError:
-        logger.exception("eliminar_pestana: OperationalError")
+        logger.error("eliminar_pestana: OperationalError", exc_info=_traza())
         db.rollback()
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except HTTPException:
@@ -963,15 +1800,11 @@ def eliminar_pestana(pestana_id: int = Path(...), db = Depends(obtener_bd)):
 @app.post("/login", response_model=RespuestaUsuario)
 def login(datos: PeticionInicio, db=Depends(obtener_bd)):
     try:
-        rol_value = datos.rol.value if hasattr(datos.rol, "value") else datos.rol
+        rol_value = datos.rol
 
-        usuario = (
-            db.query(Usuario)
-            .filter(Usuario.codigo == datos.codigo, Usuario.rol == rol_value)
-            .first()
-        )
+        usuario = db.execute(SQL_LOGIN_USUARIO, {"codigo": datos.codigo, "rol": rol_value}).mappings().first()
     except OperationalError as e:
-        logger.exception("login: OperationalError")
+        logger.error("login: OperationalError", exc_info=_traza())
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     except HTTPException:
         # si obtener_bd ya lanzo HTTPException (ej: 503) dejamos pasar
@@ -983,27 +1816,27 @@ def login(datos: PeticionInicio, db=Depends(obtener_bd)):
     if not usuario:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
-    if (rol_value or "").lower() == "profesor":
-        if not datos.clave:
+    # copiar lo necesario y liberar la conexion antes de verificar/serializar
+    respuesta = {"id": usuario["id"], "rol": usuario["rol"], "codigo": usuario["codigo"]}
+    stored = usuario["clave"] or ""
+    try:
+        db.close()
+    except Exception:
+        pass
+
+    # el schema valida rol contra el Literal: basta comparar con el valor canonico
+    if rol_value == "Profesor":
+        clave = valor_secreto(datos.clave)
+        if not clave:
             raise HTTPException(status_code=401, detail="Clave requerida")
 
-        stored = usuario.clave or ""
-        verified = (datos.clave == stored)
+        # comparacion en tiempo constante
+        verified = hmac.compare_digest(clave.encode(), stored.encode())
 
         if not verified:
             raise HTTPException(status_code=401, detail="Clave incorrecta")
 
-    return usuario
-
-# -------------------------------------------------
-# Incluir pdf_control router (import despues de inicializar supabase y helpers)
-# -------------------------------------------------
-try:
-    from pdf_control import router as pdf_router  # type: ignore
-    app.include_router(pdf_router)
-    logger.info("pdf_control router incluido correctamente")
-except Exception as e:
-    logger.exception("No se pudo incluir pdf_control router: %s", e)
+    return respuesta
 
 # run local (solo para debug)
 if __name__ == "__main__":
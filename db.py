@@ -6,10 +6,9 @@ import logging
 import threading
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import OperationalError, DBAPIError
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import DeclarativeBase, sessionmaker
+from sqlalchemy.exc import OperationalError, DBAPIError, TimeoutError as PoolTimeoutError
 
 from fastapi import HTTPException
 
@@ -33,23 +32,38 @@ if not DATABASE_URL:
 
 DATABASE_URL = ensure_sslmode(DATABASE_URL)
 
-POOL_SIZE = int(os.environ.get("POOL_SIZE", "2"))
-MAX_OVERFLOW = int(os.environ.get("MAX_OVERFLOW", "0"))
-POOL_TIMEOUT = int(os.environ.get("POOL_TIMEOUT", "15"))
+# pool dimensionado para el threadpool de FastAPI: con 2 conexiones y sin overflow las
+# peticiones concurrentes hacian cola en pool_timeout; 10+10 sigue lejos del limite de Supabase
+POOL_SIZE = int(os.environ.get("POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.environ.get("MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = int(os.environ.get("POOL_TIMEOUT", "30"))
 POOL_RECYCLE = int(os.environ.get("POOL_RECYCLE", "1800"))
 CONNECT_TIMEOUT = int(os.environ.get("CONNECT_TIMEOUT", "10"))
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "1200"))
+STATEMENT_TIMEOUT_MS = int(os.environ.get("STATEMENT_TIMEOUT_MS", "5000"))  # 0 = sin limite
+# LIFO reusa la conexion mas reciente: las ociosas quedan al fondo y las recicla pool_recycle
+POOL_USE_LIFO = os.environ.get("POOL_USE_LIFO", "1") == "1"
+# keepalives TCP: evitan que el NAT/proxy corte en silencio conexiones ociosas del pool
+KEEPALIVES_IDLE = int(os.environ.get("KEEPALIVES_IDLE", "30"))  # 0 = desactivado
 
 # circuit-breaker params
 FAILURE_THRESHOLD = int(os.environ.get("CB_FAILURE_THRESHOLD", "3"))
 COOLDOWN_SECONDS = int(os.environ.get("CB_COOLDOWN", "60"))
 RETRIES = int(os.environ.get("DB_RETRIES", "3"))
 INITIAL_DELAY = float(os.environ.get("DB_INITIAL_DELAY", "0.2"))
+# conexiones que el warmup abre por adelantado (handshake TCP+TLS fuera de la primera peticion)
+WARMUP_CONNECTIONS = min(int(os.environ.get("DB_WARMUP_CONNECTIONS", "2")), POOL_SIZE)
 
-logger.info("DB config: POOL_SIZE=%s MAX_OVERFLOW=%s POOL_TIMEOUT=%s POOL_RECYCLE=%s CONNECT_TIMEOUT=%s",
-            POOL_SIZE, MAX_OVERFLOW, POOL_TIMEOUT, POOL_RECYCLE, CONNECT_TIMEOUT)
+logger.info("DB config: POOL_SIZE=%s MAX_OVERFLOW=%s POOL_TIMEOUT=%s POOL_RECYCLE=%s POOL_USE_LIFO=%s CONNECT_TIMEOUT=%s STATEMENT_TIMEOUT_MS=%s",
+            POOL_SIZE, MAX_OVERFLOW, POOL_TIMEOUT, POOL_RECYCLE, POOL_USE_LIFO, CONNECT_TIMEOUT, STATEMENT_TIMEOUT_MS)
 logger.info("CB config: FAILURE_THRESHOLD=%s COOLDOWN_SECONDS=%s RETRIES=%s INITIAL_DELAY=%s",
             FAILURE_THRESHOLD, COOLDOWN_SECONDS, RETRIES, INITIAL_DELAY)
 
+_CONNECT_ARGS = {"connect_timeout": CONNECT_TIMEOUT}
+if KEEPALIVES_IDLE > 0:
+    _CONNECT_ARGS.update(keepalives=1, keepalives_idle=KEEPALIVES_IDLE,
+                         keepalives_interval=10, keepalives_count=3)
+
 # --- engine unico ---
 engine = create_engine(
     DATABASE_URL,
@@ -58,19 +72,37 @@ engine = create_engine(
     max_overflow=MAX_OVERFLOW,
     pool_timeout=POOL_TIMEOUT,
     pool_recycle=POOL_RECYCLE,
-    connect_args={"connect_timeout": CONNECT_TIMEOUT},
+    pool_use_lifo=POOL_USE_LIFO,
+    connect_args=_CONNECT_ARGS,
+    query_cache_size=QUERY_CACHE_SIZE,
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
+# expire_on_commit=False: leer atributos tras commit no dispara un SELECT de recarga
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, expire_on_commit=False)
+
+if STATEMENT_TIMEOUT_MS > 0:
+    @event.listens_for(SessionLocal, "after_begin")
+    def _set_statement_timeout(session, transaction, connection):
+        # SET LOCAL dura solo la transaccion: una consulta bloqueada no retiene
+        # indefinidamente una conexion del pool (compatible con pgbouncer en modo transaccion)
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {STATEMENT_TIMEOUT_MS}")
+
+# base declarativa de SQLAlchemy 2.x (declarative_base() es la API legacy)
+class Base(DeclarativeBase):
+    pass
+
+# ping de init_db/ping_db: va directo al DBAPI, sin compilar ni consultar la cache de SQL
+_PING = "SELECT 1"
 
 # --- estado del circuit-breaker (compartido en proceso) ---
 _cb_lock = threading.Lock()
 _cb_fail_count = 0
-_cb_open_until = 0.0  # monotonic timestamp
+_cb_open_until = 0  # monotonic en ns (enteros: sin redondeo de float)
+_last_ok = 0  # monotonic en ns del ultimo contacto exitoso con la BD
+_NS = 1_000_000_000
+_COOLDOWN_NS = COOLDOWN_SECONDS * _NS
 
-def _now() -> float:
-    return time.monotonic()
+_now = time.monotonic_ns
 
 def _circuit_is_open() -> bool:
     return _now() < _cb_open_until
@@ -81,17 +113,21 @@ def _record_failure():
         _cb_fail_count += 1
         logger.warning("DB failure count = %d", _cb_fail_count)
         if _cb_fail_count >= FAILURE_THRESHOLD:
-            _cb_open_until = _now() + COOLDOWN_SECONDS
+            _cb_open_until = _now() + _COOLDOWN_NS
             logger.error("Circuit breaker abierto hasta %s (por %d fallos)",
-                         time.ctime(time.time() + ( _cb_open_until - _now() )), _cb_fail_count)
+                         time.ctime(time.time() + COOLDOWN_SECONDS), _cb_fail_count)
 
 def _record_success():
-    global _cb_fail_count, _cb_open_until
+    global _cb_fail_count, _cb_open_until, _last_ok
+    _last_ok = _now()
+    # camino habitual sin lock: nada que resetear (lectura atomica bajo el GIL)
+    if _cb_fail_count == 0 and _cb_open_until == 0:
+        return
     with _cb_lock:
-        if _cb_fail_count != 0 or _cb_open_until != 0.0:
+        if _cb_fail_count != 0 or _cb_open_until != 0:
             logger.info("DB conexion exitosa: reseteando contador de fallos")
         _cb_fail_count = 0
-        _cb_open_until = 0.0
+        _cb_open_until = 0
 
 # flag opcional para saber si init_db() ha comprobado la db en startup
 _db_warm = False
@@ -107,87 +143,125 @@ def init_db(startup_retries: int = 3, startup_delay: float = 1.0):
         try:
             logger.info("Init DB: intento %d/%d", i, startup_retries)
             with engine.connect() as conn:
-                conn.execute(text("SELECT 1"))
+                conn.exec_driver_sql(_PING)
             _db_warm = True
             logger.info("Init DB: conexión verificada correctamente")
+            _precalentar_pool(WARMUP_CONNECTIONS)
             return
         except Exception as e:
             last_exc = e
             logger.warning("Init DB intento %d falló: %s", i, str(e))
-            time.sleep(startup_delay * i)
+            if i < startup_retries:
+                # backoff exponencial con jitter: las replicas que arrancan juntas no reconectan a la vez
+                time.sleep(min(startup_delay * (2 ** (i - 1)) + random.uniform(0, 0.5), 30.0))
     logger.error("Init DB: todos los intentos fallaron: %s", str(last_exc), exc_info=True)
     # No raising here para que el proceso siga corriendo; el circuit-breaker maneja peticiones.
 
-def obtener_bd():
+def _precalentar_pool(n: int):
+    # abrir n conexiones a la vez y devolverlas: quedan en el pool listas para usar
+    conns = []
+    try:
+        for _ in range(n):
+            conns.append(engine.connect())
+    except Exception as e:
+        logger.warning("Warmup del pool incompleto (%d/%d): %s", len(conns), n, e)
+    finally:
+        for c in conns:
+            c.close()
+
+def init_db_en_segundo_plano(startup_retries: int = 3, startup_delay: float = 1.0) -> threading.Thread:
     """
-    Dependencia FastAPI: yield una session SQLAlchemy.
-    - Si el circuit-breaker esta abierto devuelve HTTP 503 inmediatamente (con Retry-After).
-    - Intenta RETRIES veces con backoff/jitter corto antes de devolver 503.
+    Lanza init_db en un hilo daemon: el arranque no espera a la BD y las primeras
+    peticiones quedan cubiertas por pool_pre_ping + circuit-breaker.
+    """
+    t = threading.Thread(target=init_db, args=(startup_retries, startup_delay),
+                         name="db-warmup", daemon=True)
+    t.start()
+    return t
+
+def _cabeceras_503(retry_after: int) -> dict:
+    # jitter en Retry-After: los clientes rechazados en el mismo instante no reintentan
+    # todos juntos al cerrarse el circuito; no-store evita que un proxy cachee el 503
+    return {"Retry-After": str(retry_after + random.randint(0, max(1, retry_after // 4))),
+            "Cache-Control": "no-store"}
+
+def _abrir_sesion():
+    """
+    Devuelve una session con su conexion ya obtenida del pool.
+    - Si el circuit-breaker esta abierto lanza HTTP 503 inmediatamente (con Retry-After).
+    - Intenta RETRIES veces con backoff/jitter corto antes de lanzar 503.
     - En exito, resetea el circuit-breaker.
     """
     # si circuito abierto -> 503 sin intentar
     if _circuit_is_open():
-        until = time.time() + (_cb_open_until - _now())
-        retry_after = int(round(_cb_open_until - _now()))
+        retry_after = max(1, -(-(_cb_open_until - _now()) // _NS))  # techo en segundos
         logger.warning("Solicitud rechazada por circuit-breaker abierto durante %d s", retry_after)
-        raise HTTPException(status_code=503, detail="Base de datos temporalmente inaccesible", headers={"Retry-After": str(retry_after)})
+        raise HTTPException(status_code=503, detail="Base de datos temporalmente inaccesible", headers=_cabeceras_503(retry_after))
 
     delay = INITIAL_DELAY
-    last_exc = None
-
     for intento in range(1, RETRIES + 1):
         db = SessionLocal()
         try:
-            # ping rápido y fiable
-            with engine.connect() as conn:
-                conn.execute(text("SELECT 1"))
-            # éxito: resetear circuit-breaker y yield session
+            # checkout de la conexion de la propia session: pool_pre_ping ya valida la
+            # conexion, asi que no hace falta un SELECT 1 extra ni un segundo checkout
+            db.connection()
             _record_success()
-            try:
-                yield db
-            finally:
-                try:
-                    db.close()
-                except Exception:
-                    pass
-            return
+            return db
+        except PoolTimeoutError:
+            # pool agotado: la BD responde pero no hay conexiones libres; reintentar solo
+            # encadenaria otras esperas de pool_timeout, y no cuenta como fallo de la BD
+            db.close()
+            logger.warning("Pool de conexiones agotado tras %ss", POOL_TIMEOUT)
+            raise HTTPException(status_code=503, detail="Servicio ocupado, intente de nuevo", headers=_cabeceras_503(1))
         except (OperationalError, DBAPIError) as oe:
-            last_exc = oe
-            try:
-                db.close()
-            except Exception:
-                pass
-
-            logger.warning("Intento %d/%d - OperationalError/DBAPIError al conectar a DB: %s", intento, RETRIES, repr(oe))
-
+            db.close()
+            logger.warning("Intento %d/%d - OperationalError/DBAPIError al conectar a DB: %r", intento, RETRIES, oe)
             # registrar fallo en circuit-breaker
             _record_failure()
-
-            if intento < RETRIES:
-                # backoff exponencial con jitter corto (blocking)
-                jitter = random.uniform(0, 0.25 * delay)
-                sleep_time = delay + jitter
-                logger.info("Durmiendo %.3fs antes del proximo intento", sleep_time)
-                time.sleep(sleep_time)
-                delay = min(delay * 2, 10.0)  # limitar crecimiento
-                continue
-            else:
-                logger.error("Reintentos DB agotados: %s", repr(last_exc), exc_info=True)
-                raise HTTPException(status_code=503, detail="Base de datos temporalmente inaccesible", headers={"Retry-After": str(COOLDOWN_SECONDS)})
+            if intento == RETRIES:
+                logger.error("Reintentos DB agotados: %r", oe, exc_info=True)
+                raise HTTPException(status_code=503, detail="Base de datos temporalmente inaccesible", headers=_cabeceras_503(COOLDOWN_SECONDS))
+            # backoff exponencial con jitter corto (blocking)
+            sleep_time = delay + random.uniform(0, 0.25 * delay)
+            logger.debug("Durmiendo %.3fs antes del proximo intento", sleep_time)
+            time.sleep(sleep_time)
+            delay = min(delay * 2, 10.0)  # limitar crecimiento
         except Exception as e:
-            try:
-                db.close()
-            except Exception:
-                pass
+            db.close()
             logger.exception("Error inesperado al obtener session DB: %s", e)
             # devolver 500: excepción inesperada
             raise HTTPException(status_code=500, detail="Error interno al obtener DB")
 
+def obtener_bd():
+    """
+    Dependencia FastAPI: yield una session SQLAlchemy.
+    Los reintentos ocurren antes del yield (en _abrir_sesion): una excepcion del
+    handler nunca vuelve a entrar al bucle de reintentos.
+    """
+    db = _abrir_sesion()
+    try:
+        yield db
+    finally:
+        db.close()
+
 # helper util: para scripts/tests
 def ping_db() -> bool:
+    global _last_ok
     try:
         with engine.connect() as conn:
-            conn.execute(text("SELECT 1"))
+            conn.exec_driver_sql(_PING)
+        _last_ok = _now()
         return True
     except Exception:
         return False
+
+def ping_db_reciente(max_age: float) -> bool:
+    """
+    Igual que ping_db, pero si hubo un contacto exitoso hace menos de max_age
+    segundos devuelve True sin tocar el pool.
+    """
+    if _now() - _last_ok < max_age * _NS:
+        return True
+    if _circuit_is_open():
+        return False
+    return ping_db()
@@ -1,5 +1,9 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Boolean, Text, ForeignKey, TIMESTAMP
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import Integer, String, Boolean, Text, ForeignKey, TIMESTAMP
+from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import ENUM as PG_ENUM
 from sqlalchemy.dialects.postgresql import ARRAY, INTEGER
@@ -11,28 +15,28 @@ role_enum = PG_ENUM('Estudiante', 'Profesor', name='role_type', create_type=Fals
 
 class Usuario(Base):
     __tablename__ = "usuarios"
-    id = Column(Integer, primary_key=True, index=True)
-    rol = Column(role_enum, nullable=False)
-    codigo = Column(String(64), unique=True, nullable=False, index=True)
-    clave = Column(Text, nullable=True)
-    creado_en = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    rol: Mapped[str] = mapped_column(role_enum, nullable=False)
+    codigo: Mapped[str] = mapped_column(String(64), unique=True, nullable=False, index=True)
+    clave: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    creado_en: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
 
     def __repr__(self):
         return f"<Usuario id={self.id} codigo={self.codigo} rol={self.rol}>"
 
 class Recurso(Base):
     __tablename__ = "recursos"
-    id = Column(Integer, primary_key=True, index=True)
-    titulo = Column(Text, nullable=False)
-    tipo = Column(String(16), nullable=False)
-    ruta = Column(Text, nullable=True)
-    file_path = Column(Text, nullable=True)
-    url_youtube = Column(Text, nullable=True)
-    youtube_id = Column(String(64), nullable=True)
-    subido_por = Column(Integer, ForeignKey("usuarios.id", ondelete="SET NULL"), nullable=True)
-    publico = Column(Boolean, default=False)
-    creado_en = Column(TIMESTAMP(timezone=True), server_default=func.now())
-    actualizado_en = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    titulo: Mapped[str] = mapped_column(Text, nullable=False)
+    tipo: Mapped[str] = mapped_column(String(16), nullable=False)
+    ruta: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    file_path: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    url_youtube: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    youtube_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    subido_por: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("usuarios.id", ondelete="SET NULL"), nullable=True)
+    publico: Mapped[Optional[bool]] = mapped_column(Boolean, default=False)
+    creado_en: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+    actualizado_en: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
 
     def __repr__(self):
         return f"<Recurso id={self.id} titulo={self.titulo} tipo={self.tipo}>"
@@ -42,11 +46,11 @@ class Recurso(Base):
 # -------------------------------------
 class Pestana(Base):
     __tablename__ = "pestanas"
-    id = Column(Integer, primary_key=True, index=True)
-    nombre = Column(String, nullable=False)
-    orden = Column(ARRAY(INTEGER), nullable=False, default=[])  # lista de ids de recursos
-    creado_en = Column(TIMESTAMP(timezone=True), server_default=func.now())
-    actualizado_en = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    nombre: Mapped[str] = mapped_column(String, nullable=False)
+    orden: Mapped[List[int]] = mapped_column(ARRAY(INTEGER), nullable=False, default=list)  # lista de ids de recursos
+    creado_en: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+    actualizado_en: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
 
     def __repr__(self):
         return f"<Pestana id={self.id} nombre={self.nombre}>"
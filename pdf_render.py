@@ -0,0 +1,88 @@
+# pdf_render.py
+# Render de paginas PDF a imagen. Modulo liviano (sin FastAPI/BD) para que los
+# procesos del pool de previews lo importen rapido.
+import io
+
+# Pillow es opcional: si esta, codifica previews con zlib nivel 1 y permite WebP/JPEG
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+
+PIL_DISPONIBLE = Image is not None
+
+# codifica el pixmap; con Pillow se prioriza velocidad (zlib nivel 1) sobre tamano
+_MODOS_PIL = {1: "L", 3: "RGB", 4: "RGBA"}
+
+JPEG_QUALITY = 75
+
+def codificar_pixmap(pix, formato: str) -> bytes:
+    modo = _MODOS_PIL.get(pix.n)
+    if Image is None or modo is None:
+        if formato == "jpeg":
+            return pix.tobytes("jpeg", jpg_quality=JPEG_QUALITY)
+        return pix.tobytes("png")
+    img = Image.frombuffer(modo, (pix.width, pix.height), pix.samples, "raw", modo, pix.stride, 1)
+    out = io.BytesIO()
+    if formato == "webp":
+        img.save(out, format="WEBP", quality=85, method=0)
+    elif formato == "jpeg":
+        img.save(out, format="JPEG", quality=JPEG_QUALITY)
+    else:
+        img.save(out, format="PNG", compress_level=1, optimize=False)
+    return out.getvalue()
+
+# convierte una pagina del PDF a imagen (png/webp) con PyMuPDF
+# lanza ImportError si PyMuPDF no esta instalado e IndexError si la pagina no existe
+def render_pagina(bytes_pdf: bytes, pagina: int, dpi: int, formato: str = "png") -> bytes:
+    import fitz  # pymupdf
+
+    doc = fitz.open(stream=bytes_pdf, filetype="pdf")
+    try:
+        if pagina < 0 or pagina >= doc.page_count:
+            raise IndexError("Pagina fuera de rango")
+        pag = doc.load_page(pagina)
+        # RGB sin alfa: menos muestras que codificar y valido para JPEG
+        pix = pag.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+        return codificar_pixmap(pix, formato)
+    finally:
+        doc.close()
+
+# convierte varias paginas abriendo el PDF una sola vez (el parseo se amortiza)
+def render_paginas(bytes_pdf: bytes, paginas, dpi: int, formato: str = "png") -> list:
+    import fitz  # pymupdf
+
+    doc = fitz.open(stream=bytes_pdf, filetype="pdf")
+    try:
+        if any(p < 0 or p >= doc.page_count for p in paginas):
+            raise IndexError("Pagina fuera de rango")
+        return [
+            codificar_pixmap(doc.load_page(p).get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False), formato)
+            for p in paginas
+        ]
+    finally:
+        doc.close()
+
+# como render_paginas, pero omite las paginas fuera de rango; devuelve [(pagina, imagen)]
+def render_paginas_existentes(bytes_pdf: bytes, paginas, dpi: int, formato: str = "png") -> list:
+    import fitz  # pymupdf
+
+    doc = fitz.open(stream=bytes_pdf, filetype="pdf")
+    try:
+        return [
+            (p, codificar_pixmap(doc.load_page(p).get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False), formato))
+            for p in paginas
+            if 0 <= p < doc.page_count
+        ]
+    finally:
+        doc.close()
+
+# numero de paginas sin renderizar nada
+def contar_paginas(bytes_pdf: bytes) -> int:
+    import fitz  # pymupdf
+
+    doc = fitz.open(stream=bytes_pdf, filetype="pdf")
+    try:
+        return doc.page_count
+    finally:
+        doc.close()
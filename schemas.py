@@ -1,79 +1,91 @@
 #schemas.py
-from pydantic import BaseModel
-from typing import Optional, List
+from datetime import datetime
+from pydantic import BaseModel, ConfigDict, Field, PositiveInt, SecretStr, TypeAdapter
+from typing import Optional, List, Literal, Annotated
 
-from enum import Enum as PyEnum
-
-class RoleEnum(str, PyEnum):
-    Estudiante = "Estudiante"
-    Profesor = "Profesor"
+# Literal: validacion directa en pydantic-core y los handlers reciben rol como str
+Rol = Literal["Estudiante", "Profesor"]
 
+# clave de entrada como SecretStr: no aparece en repr, logs ni model_dump_json
 class PeticionInicio(BaseModel):
-    rol: RoleEnum
+    rol: Rol
     codigo: str
-    clave: Optional[str] = None
+    clave: Optional[SecretStr] = None
+
+# modelos de salida: se leen de filas de la BD y no se mutan (frozen); config unica compartida
+_CONFIG_SALIDA = ConfigDict(from_attributes=True, frozen=True)
 
 class RespuestaUsuario(BaseModel):
-    id: int
+    id: PositiveInt
     rol: str
     codigo: str
-    clave: Optional[str] = None
-    model_config = {"from_attributes": True}
+    model_config = _CONFIG_SALIDA
 
 class UsuarioCreate(BaseModel):
-    rol: RoleEnum
+    rol: Rol
     codigo: str
-    clave: Optional[str] = None
+    clave: Optional[SecretStr] = None
 
 class UsuarioUpdate(BaseModel):
-    rol: Optional[RoleEnum] = None
+    rol: Optional[Rol] = None
     codigo: Optional[str] = None
-    clave: Optional[str] = None
+    clave: Optional[SecretStr] = None
 
 # Recurso
+# ruta dentro del bucket (como la genera nombre_en_bucket): el patron se compila una vez en
+# pydantic-core; ruta no se restringe porque es una URL completa
+RutaBucket = Annotated[str, Field(pattern=r"^[A-Za-z0-9_./-]+$", max_length=512)]
+
 class RecursoBase(BaseModel):
     titulo: str
     tipo: str
     ruta: Optional[str] = None
-    file_path: Optional[str] = None
+    file_path: Optional[RutaBucket] = None
     url_youtube: Optional[str] = None
     youtube_id: Optional[str] = None
-    subido_por: Optional[int] = None
+    subido_por: Optional[PositiveInt] = None
     publico: Optional[bool] = False
 
-class RecursoCreate(RecursoBase):
-    pass
+# alias, no subclase: sin campos propios no hace falta un segundo validador
+RecursoCreate = RecursoBase
 
 class RecursoUpdate(BaseModel):
     titulo: Optional[str] = None
     tipo: Optional[str] = None
     ruta: Optional[str] = None
-    file_path: Optional[str] = None
+    file_path: Optional[RutaBucket] = None
     url_youtube: Optional[str] = None
     youtube_id: Optional[str] = None
-    subido_por: Optional[int] = None
+    subido_por: Optional[PositiveInt] = None
     publico: Optional[bool] = None
 
 class RecursoOut(RecursoBase):
-    id: int
-    creado_en: Optional[str] = None
-    model_config = {"from_attributes": True}
+    id: PositiveInt
+    # salida: filas historicas pueden tener rutas fuera del patron de entrada
+    file_path: Optional[str] = None
+    creado_en: Optional[datetime] = None
+    model_config = _CONFIG_SALIDA
 
 # ------------------------------------------------
 # Pestanas (nueva entidad para ordenar recursos)
 # ------------------------------------------------
 class PestanaBase(BaseModel):
     nombre: str
-    orden: Optional[List[int]] = []
+    # default_factory: lista nueva por instancia, sin copiar un default mutable
+    orden: Optional[List[int]] = Field(default_factory=list)
 
-class PestanaCreate(PestanaBase):
-    pass
+PestanaCreate = PestanaBase
 
 class PestanaUpdate(BaseModel):
     nombre: Optional[str] = None
     orden: Optional[List[int]] = None
 
 class PestanaOut(PestanaBase):
-    id: int
-    creado_en: Optional[str] = None
-    model_config = {"from_attributes": True}
+    id: PositiveInt
+    creado_en: Optional[datetime] = None
+    model_config = _CONFIG_SALIDA
+
+# adaptadores de listas construidos una vez: validan filas y serializan a JSON en pydantic-core
+USUARIOS_LIST = TypeAdapter(List[RespuestaUsuario])
+RECURSOS_LIST = TypeAdapter(List[RecursoOut])
+PESTANAS_LIST = TypeAdapter(List[PestanaOut])